@@ -0,0 +1,119 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+import torch
+from benchmark import volume_store
+
+
+def file_sha1(path, buffer_size=65536):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(buffer_size)
+            if not data:
+                break
+            sha1.update(data)
+    return sha1.hexdigest()
+
+
+def transforms_key(transform_names, transforms_file):
+    '''
+    Identifies a preprocessing chain by the ordered transform names and the
+    source of the module that builds them, since transform parameters live there.
+    '''
+    sha1 = hashlib.sha1(json.dumps(list(transform_names)).encode())
+    sha1.update(file_sha1(transforms_file).encode())
+    return sha1.hexdigest()
+
+
+class PreprocessingCache():
+    '''
+    On-disk cache of deterministic preprocessing outputs.
+    Entries are keyed by the content of every input file of a case plus the
+    transforms key, and the least recently used ones are evicted once the cache
+    grows over max_size bytes.
+    '''
+    suffix = '.pt'
+
+    def __init__(self, cache_dir, transforms_key, max_size=None):
+        self.cache_dir = cache_dir
+        self.transforms_key = transforms_key
+        self.max_size = max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Shared counters so lookups done in data loader workers are accounted for
+        self._hits = multiprocessing.Value('i', 0)
+        self._misses = multiprocessing.Value('i', 0)
+
+    @property
+    def hits(self):
+        return self._hits.value
+
+    @property
+    def misses(self):
+        return self._misses.value
+
+    def key(self, item):
+        sha1 = hashlib.sha1(self.transforms_key.encode())
+        for name in sorted(item.keys()):
+            value = item[name]
+            sha1.update(name.encode())
+            if isinstance(value, str) and os.path.isfile(value):
+                sha1.update(file_sha1(value).encode())
+                if value.endswith(volume_store.HEADER_SUFFIX):
+                    # Volume store headers only describe the volume, the voxels are in the data file
+                    sha1.update(file_sha1(volume_store.data_path(value)).encode())
+            else:
+                sha1.update(repr(value).encode())
+        return sha1.hexdigest()
+
+    def get(self, item):
+        path = os.path.join(self.cache_dir, self.key(item) + self.suffix)
+        try:
+            data = torch.load(path)
+        except (OSError, EOFError, RuntimeError):
+            with self._misses.get_lock():
+                self._misses.value += 1
+            return None
+        # Refresh the entry so eviction sees it as recently used
+        os.utime(path, None)
+        with self._hits.get_lock():
+            self._hits.value += 1
+        return data
+
+    def put(self, item, data):
+        path = os.path.join(self.cache_dir, self.key(item) + self.suffix)
+        # Write to a temporary file first so concurrent readers never see partial entries
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                torch.save(data, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        if self.max_size is not None:
+            self.evict()
+
+    def evict(self):
+        entries = []
+        total_size = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(self.suffix):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
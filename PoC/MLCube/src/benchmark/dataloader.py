@@ -1,5 +1,51 @@
+import inspect
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from monai.data import list_data_collate
 from torch.utils.data import DataLoader
 
+# prefetch_factor is only understood by torch>=1.7 and only with worker processes
+_SUPPORTS_PREFETCH = 'prefetch_factor' in inspect.signature(DataLoader.__init__).parameters
+
 class DataLoader(DataLoader):
-    def __init__(self, dataset, num_workers=0):
-        super().__init__(dataset=dataset,num_workers=num_workers)
\ No newline at end of file
+    def __init__(self, dataset, batch_size=1, num_workers=0, prefetch_factor=2, shuffle=False):
+        kwargs = {}
+        if num_workers > 0 and _SUPPORTS_PREFETCH:
+            kwargs['prefetch_factor'] = prefetch_factor
+        super().__init__(dataset=dataset, batch_size=batch_size, num_workers=num_workers,
+                shuffle=shuffle, collate_fn=list_data_collate, **kwargs)
+
+class PrefetchLoader():
+    '''
+    Streams batches from a dataset while a thread pool decodes and preprocesses
+    the upcoming cases. At most `depth` batches are in flight, so the first batch
+    is ready as soon as its own cases are, and memory does not grow with the
+    partition size.
+    '''
+    def __init__(self, dataset, batch_size=1, num_threads=1, depth=2):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self.depth = depth
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        max_in_flight = max(self.depth, 1) * self.batch_size
+        indices = iter(range(len(self.dataset)))
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            for index in islice(indices, max_in_flight):
+                pending.append(executor.submit(self.dataset.__getitem__, index))
+            batch = []
+            while pending:
+                batch.append(pending.popleft().result())
+                for index in islice(indices, 1):
+                    pending.append(executor.submit(self.dataset.__getitem__, index))
+                if len(batch) == self.batch_size:
+                    yield list_data_collate(batch)
+                    batch = []
+            if batch:
+                yield list_data_collate(batch)
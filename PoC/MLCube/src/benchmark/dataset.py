@@ -1,5 +1,163 @@
-from monai.data import CacheDataset
+import logging
+import threading
+import numpy as np
+import torch
+from monai.data import CacheDataset, Dataset
+from monai.transforms import Compose, Randomizable, Transform, apply_transform
+
+logger = logging.getLogger(__name__)
+
+# Storage types of the compact dataset
+IMAGE_DTYPES = ['float32', 'float16', 'bfloat16']
+LABEL_FORMATS = ['float32', 'uint8', 'bits']
 
 class DataSet(CacheDataset):
     def __init__(self, dataset, transforms):
-        super().__init__(data=dataset, transform=transforms)
\ No newline at end of file
+        super().__init__(data=dataset, transform=transforms)
+
+class StreamingDataSet(Dataset):
+    '''
+    Dataset that preprocesses each case when it is requested instead of caching
+    the whole partition in memory up front.
+    '''
+    def __init__(self, dataset, transforms):
+        super().__init__(data=dataset, transform=transforms)
+
+class PersistentDataSet(Dataset):
+    '''
+    Dataset backed by an on-disk PreprocessingCache.
+    Only the deterministic prefix of the transform chain is cached, transforms
+    from the first random one onwards are applied on every access.
+    '''
+    def __init__(self, dataset, transforms, cache):
+        super().__init__(data=dataset, transform=transforms)
+        self.cache = cache
+        self.cached_transforms = []
+        self.remaining_transforms = []
+        for transform in transforms.transforms:
+            if self.remaining_transforms or isinstance(transform, Randomizable) \
+                    or not isinstance(transform, Transform):
+                self.remaining_transforms.append(transform)
+            else:
+                self.cached_transforms.append(transform)
+
+    def __getitem__(self, index):
+        item = self.data[index]
+        data = self.cache.get(item)
+        if data is None:
+            data = apply_transform(Compose(self.cached_transforms), item)
+            self.cache.put(item, data)
+        if self.remaining_transforms:
+            data = apply_transform(Compose(self.remaining_transforms), data)
+        return data
+
+
+def nbytes(value):
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, PackedMask):
+        return value.bits.nbytes
+    return 0
+
+
+class PackedMask():
+    '''
+    Binary mask stored as one bit per voxel.
+    '''
+    def __init__(self, mask):
+        self.shape = tuple(mask.shape)
+        self.bits = np.packbits(mask.cpu().numpy() != 0)
+
+    def unpack(self):
+        count = int(np.prod(self.shape))
+        return torch.from_numpy(np.unpackbits(self.bits, count=count).reshape(self.shape))
+
+
+def compact_image(image, dtype_name):
+    dtype = getattr(torch, dtype_name, None)
+    if dtype is None:
+        logger.warning(f"This torch release has no {dtype_name} type, keeping float32 images")
+        return image
+    return image.to(dtype)
+
+
+def compact_label(label, label_format):
+    if label_format == 'bits':
+        if bool(((label == 0) | (label == 1)).all()):
+            return PackedMask(label)
+        logger.warning("Label is not binary, storing it as uint8 instead of bits")
+    if float(label.min()) >= 0 and float(label.max()) <= 255 and bool((label == label.round()).all()):
+        return label.to(torch.uint8)
+    logger.warning("Label values don't fit uint8, keeping them unchanged")
+    return label
+
+
+class CompactDataSet(DataSet):
+    '''
+    CacheDataset holding images in a narrower float type and labels as uint8 or one bit
+    per voxel. Packed labels are unpacked to uint8 when a case is accessed, images and
+    labels are widened back to float32 per batch right before the model.
+    Labels are assumed to be binary masks or small integer classes.
+    '''
+    def __init__(self, dataset, transforms, image_dtype='float16', label_format='bits'):
+        if image_dtype not in IMAGE_DTYPES:
+            raise ValueError(f"Unknown image dtype: {image_dtype}")
+        if label_format not in LABEL_FORMATS:
+            raise ValueError(f"Unknown label format: {label_format}")
+        self.image_dtype = image_dtype
+        self.label_format = label_format
+        self.original_bytes = {}
+        self.compact_bytes = {}
+        self.lock = threading.Lock()
+        super().__init__(dataset, transforms)
+
+    def _load_cache_item(self, item):
+        data = super()._load_cache_item(item)
+        data = dict(data)
+        for key in ['image', 'label']:
+            value = data.get(key)
+            if not isinstance(value, (torch.Tensor, np.ndarray)):
+                continue
+            original = nbytes(value)
+            value = torch.as_tensor(value)
+            if key == 'image' and self.image_dtype != 'float32':
+                value = compact_image(value, self.image_dtype)
+            elif key == 'label' and self.label_format != 'float32':
+                value = compact_label(value, self.label_format)
+            data[key] = value
+            with self.lock:
+                self.original_bytes[key] = self.original_bytes.get(key, 0) + original
+                self.compact_bytes[key] = self.compact_bytes.get(key, 0) + nbytes(value)
+        return data
+
+    def __getitem__(self, index):
+        if index >= self.cache_num:
+            return super().__getitem__(index)
+        data = dict(self._cache[index])
+        for key, value in data.items():
+            if isinstance(value, PackedMask):
+                data[key] = value.unpack()
+        # Transforms from the first random one onwards are not cached
+        remaining = []
+        for transform in self.transform.transforms:
+            if remaining or isinstance(transform, Randomizable) or not isinstance(transform, Transform):
+                remaining.append(transform)
+        if remaining:
+            data = apply_transform(Compose(remaining), data)
+        return data
+
+    def footprint(self):
+        '''
+        :return: cached bytes per case before and after compaction, for every key
+        '''
+        cases = max(self.cache_num, 1)
+        footprint = {'cases': self.cache_num}
+        for key in self.original_bytes:
+            footprint[key] = {
+                'original_bytes_per_case': self.original_bytes[key] / cases,
+                'compact_bytes_per_case': self.compact_bytes[key] / cases,
+                'saved_bytes_per_case': (self.original_bytes[key] - self.compact_bytes[key]) / cases,
+            }
+        return footprint
@@ -0,0 +1,29 @@
+import pickle
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+def shard_indices(length, rank, world_size):
+    '''
+    :return: indices of the cases evaluated by rank, interleaved so every shard gets
+        a similar share of the list
+    '''
+    return list(range(rank, length, world_size))
+
+
+def all_gather_objects(obj):
+    '''
+    Gathers a picklable object from every rank of the default process group, in rank order.
+    Objects travel as padded byte tensors, which every backend and torch release supports.
+    '''
+    data = torch.from_numpy(np.frombuffer(pickle.dumps(obj), dtype=np.uint8).copy())
+    size = torch.tensor([data.numel()], dtype=torch.int64)
+    sizes = [torch.zeros_like(size) for _ in range(dist.get_world_size())]
+    dist.all_gather(sizes, size)
+    max_size = max(int(size) for size in sizes)
+    padded = torch.zeros(max_size, dtype=torch.uint8)
+    padded[:data.numel()] = data
+    buffers = [torch.zeros(max_size, dtype=torch.uint8) for _ in sizes]
+    dist.all_gather(buffers, padded)
+    return [pickle.loads(buffer[:int(size)].numpy().tobytes()) for buffer, size in zip(buffers, sizes)]
@@ -0,0 +1,40 @@
+import logging
+import torch
+from monai.losses import DiceLoss
+
+logger = logging.getLogger(__name__)
+
+
+def state_dict_copy(model):
+    '''
+    :return: detached copy of the parameters and buffers of model, to restore it without reading the weights file
+    '''
+    return {name: tensor.detach().clone() for name, tensor in model.state_dict().items()}
+
+
+def fine_tune(model, loader, epochs, learning_rate=1e-4, weight_decay=1e-5, device=torch.device('cpu')):
+    '''
+    Fine-tunes a multi-channel segmentation model with a sigmoid Dice loss, as in MONAI's
+    BraTS tutorial, and leaves it in evaluation mode.
+    :return: mean loss of every epoch
+    '''
+    loss_function = DiceLoss(smooth_nr=0, smooth_dr=1e-5, squared_pred=True, to_onehot_y=False, sigmoid=True)
+    optimizer = torch.optim.Adam(model.parameters(), learning_rate, weight_decay=weight_decay)
+    model.train()
+    losses = []
+    for epoch in range(epochs):
+        epoch_loss = 0.0
+        steps = 0
+        for batch_data in loader:
+            # Compact cached cases are widened back to float32 one batch at a time
+            inputs, labels = batch_data['image'].to(device).float(), batch_data['label'].to(device).float()
+            optimizer.zero_grad()
+            loss = loss_function(model(inputs), labels)
+            loss.backward()
+            optimizer.step()
+            epoch_loss += loss.item()
+            steps += 1
+        losses.append(epoch_loss / max(steps, 1))
+        logger.info(f"Epoch {epoch + 1}/{epochs} loss: {losses[-1]:.4f}")
+    model.eval()
+    return losses
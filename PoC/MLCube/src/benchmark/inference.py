@@ -0,0 +1,139 @@
+import copy
+import logging
+import torch
+from benchmark.metrics import Dice
+
+logger = logging.getLogger(__name__)
+
+JIT_MODES = ['none', 'trace', 'freeze']
+
+
+def inference_context():
+    # inference_mode skips autograd bookkeeping entirely, older torch releases only have no_grad
+    return getattr(torch, 'inference_mode', torch.no_grad)()
+
+
+def configure_threads(threads=None, interop_threads=None):
+    '''
+    Sets the intra-op and inter-op thread pools of this process, None keeps the torch default.
+    '''
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as err:
+            # Can only be set once, before any inter-op parallel work has started
+            logger.warning(f"Could not set inter-op threads: {err}")
+
+
+class InferenceEngine():
+    '''
+    Runs a model with the CPU optimizations configured in the "inference" section of
+    the model configuration file: channels-last-3d memory format and TorchScript tracing
+    or freezing.
+    The optimized model is built from the first batch. An accuracy guard compares the Dice values of the optimized model
+    against the eager model on the first cases and falls back to the eager model when
+    they differ by more than the tolerance, or when the optimized model fails.
+    '''
+    def __init__(self, model, config=None, device=torch.device('cpu')):
+        config = config or {}
+        self.model = model
+        self.device = device
+        self.channels_last = config.get('channels_last', False)
+        self.jit = config.get('jit') or 'none'
+        if self.jit not in JIT_MODES:
+            raise ValueError(f"Unknown jit mode: {self.jit}")
+        guard_config = config.get('accuracy_guard') or {}
+        self.guard_cases = guard_config.get('cases', 1)
+        self.tolerance = guard_config.get('tolerance', 0.01)
+        self.optimized = None
+        self.fallback = None
+        self.guarded = 0
+        self.max_dice_difference = None
+        self.memory_format = getattr(torch, 'channels_last_3d', None)
+        if self.channels_last and self.memory_format is None:
+            logger.warning("channels_last_3d is not supported by this torch release, ignoring it")
+            self.channels_last = False
+        if self.device.type != 'cpu' and self.enabled:
+            logger.warning(f"CPU optimizations are not applied on {self.device}, running the eager model")
+            self.channels_last, self.jit = False, 'none'
+
+    @property
+    def enabled(self):
+        return self.channels_last or self.jit != 'none'
+
+    def __call__(self, inputs):
+        if not self.enabled or self.fallback is not None:
+            return self.model(inputs)
+        try:
+            if self.optimized is None:
+                self.optimized = self.__build_model__(inputs)
+            return self.optimized(self.__to_memory_format__(inputs))
+        except Exception as err:
+            self.__fall_back__(f"optimized model failed: {err}")
+            return self.model(inputs)
+
+    def __to_memory_format__(self, inputs):
+        if self.channels_last and inputs.dim() == 5:
+            return inputs.contiguous(memory_format=self.memory_format)
+        return inputs
+
+    def __build_model__(self, inputs):
+        '''
+        Builds the optimized model, leaving the eager model untouched for the accuracy guard.
+        :param inputs: example batch used for tracing
+        '''
+        model = copy.deepcopy(self.model).eval()
+        if self.channels_last:
+            model = model.to(memory_format=self.memory_format)
+        inputs = self.__to_memory_format__(inputs)
+        if self.jit != 'none':
+            model = torch.jit.trace(model, inputs)
+            if self.jit == 'freeze':
+                if hasattr(torch.jit, 'freeze'):
+                    model = torch.jit.freeze(model)
+                else:
+                    logger.warning("torch.jit.freeze is not supported by this torch release, using the traced model")
+        logger.info(f"Built optimized model: {self.describe()}")
+        return model
+
+    def guard(self, predict, predictions, labels):
+        '''
+        Compares the Dice values of the optimized predictions against those of the eager model
+        while fewer than the configured number of cases have been checked.
+        :param predict: callable returning the post-processed predictions of a given network
+        :param predictions: post-processed predictions of the optimized model
+        :return: predictions to use for this batch, the eager ones if the check failed
+        '''
+        if self.optimized is None or self.fallback is not None or self.guarded >= self.guard_cases:
+            return predictions
+        reference = predict(self.model)
+        difference = (self.__dice__(predictions, labels) - self.__dice__(reference, labels)).abs().max().item()
+        self.guarded += labels.shape[0]
+        self.max_dice_difference = max(self.max_dice_difference or 0.0, difference)
+        if difference > self.tolerance:
+            self.__fall_back__(f"Dice differs from the eager model by {difference:.4f}")
+            return reference
+        return predictions
+
+    @staticmethod
+    def __dice__(y_pred, y):
+        values, not_nans = Dice()(y_pred=y_pred, y=y)
+        # Channels without a valid value on both sides compare equal
+        return torch.where(not_nans > 0, values, torch.zeros_like(values))
+
+    def __fall_back__(self, reason):
+        logger.warning(f"Falling back to the eager model: {reason}")
+        self.fallback = reason
+        self.optimized = None
+
+    def describe(self):
+        return {
+            'channels_last': self.channels_last,
+            'jit': self.jit,
+            'threads': torch.get_num_threads(),
+            'guarded_cases': self.guarded,
+            'max_dice_difference': self.max_dice_difference,
+            'fallback': self.fallback,
+        }
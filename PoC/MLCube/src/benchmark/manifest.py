@@ -0,0 +1,97 @@
+import json
+import os
+import tempfile
+import numpy as np
+
+INDEX_SUFFIX = '.idx.npy'
+
+
+def build_index(path):
+    '''
+    :return: byte offset of every line of a JSONL file
+    '''
+    offsets = []
+    offset = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                offsets.append(offset)
+            offset += len(line)
+    return np.array(offsets, dtype=np.int64)
+
+
+class PartitionManifest():
+    '''
+    Partition entries stored one JSON object per line, e.g.
+    {"image": "imagesTr/BRATS_001.nii.gz", "label": "labelsTr/BRATS_001.nii.gz"}.
+    An index of line offsets is kept next to the manifest and rebuilt when the manifest
+    changes, so the number of entries is known without parsing them and every entry is
+    only read and parsed when it is accessed.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + INDEX_SUFFIX
+        if not os.path.isfile(self.index_path) \
+                or os.path.getmtime(self.index_path) < os.path.getmtime(self.path):
+            self.__write_index__(build_index(self.path))
+        self.offsets = np.load(self.index_path, mmap_mode='r')
+        self._file = None
+        self._pid = None
+
+    def __write_index__(self, offsets):
+        # Readers in other processes never see a partial index
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.index_path)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, offsets)
+            os.replace(tmp_path, self.index_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        # Forked processes get their own file handle, a shared one would share its position
+        if self._file is None or self._pid != os.getpid():
+            self._file = open(self.path, 'rb')
+            self._pid = os.getpid()
+        self._file.seek(int(self.offsets[index]))
+        return json.loads(self._file.readline())
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_file'] = None
+        state['offsets'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.offsets = np.load(self.index_path, mmap_mode='r')
+
+
+def write_manifest(entries, path):
+    with open(path, 'w') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + '\n')
+
+
+def partition_entries(data_config, partition, data_parameters_file=None):
+    '''
+    :param partition: 'data' or 'validation data'
+    :param data_parameters_file: partition file, manifest paths are relative to its folder
+    :return: the entries of a partition, either an in-line list or a PartitionManifest
+        when the partition file gives the path of a JSONL manifest, or None
+    '''
+    entries = data_config.get(partition)
+    if isinstance(entries, str):
+        folder = os.path.dirname(data_parameters_file) if data_parameters_file else ''
+        return PartitionManifest(os.path.join(folder, entries))
+    return entries
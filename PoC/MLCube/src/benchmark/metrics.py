@@ -1,22 +1,158 @@
+import torch
 from monai.metrics import DiceMetric,HausdorffDistanceMetric
+from benchmark.hausdorff import FastHausdorffDistance
+from benchmark.profiler import Profiler
+
+# Regions of the BraTS multi-channel labels, in channel order
+REGIONS = ['TC', 'WT', 'ET']
 
 
 class Metrics():
-    def __init__(self, metrics_list):
+    def __init__(self, metrics_list, num_workers=0):
         self.metrics = []
         for metric in metrics_list:
             if 'DiceMetric' == metric:
                 self.metrics.append([Dice(),'DiceMetric'])
             if 'HausdorffDistanceMetric' == metric:
-                self.metrics.append([HausdorffDistance(),'HausdorffDistanceMetric'])
+                self.metrics.append([FastHausdorffDistance(num_workers=num_workers),'HausdorffDistanceMetric'])
+            if 'HausdorffDistance95Metric' == metric:
+                self.metrics.append([FastHausdorffDistance(percentile=95, num_workers=num_workers),
+                        'HausdorffDistance95Metric'])
 
     def __getitem__(self,index):
         return self.metrics[index]
 
 class Dice(DiceMetric):
+    '''
+    DiceMetric with reduction="none". Bool predictions, such as those of sliding window
+    inference, are compared with bool operations and integer counts instead of float copies.
+    '''
     def __init__(self):
-        super().__init__(include_background=True, reduction="mean")
+        super().__init__(include_background=True, reduction="none")
+
+    def __call__(self, y_pred, y):
+        if y_pred.dtype != torch.bool:
+            return super().__call__(y_pred=y_pred, y=y)
+        y = y if y.dtype == torch.bool else y > 0
+        dims = tuple(range(2, y_pred.dim()))
+        intersection = (y_pred & y).sum(dim=dims)
+        y_o = y.sum(dim=dims)
+        denominator = y_o + y_pred.sum(dim=dims)
+        # Like monai.metrics.compute_meandice, channels with an empty ground truth are NaN
+        f = torch.where(y_o > 0, 2.0 * intersection.float() / denominator.clamp(min=1).float(),
+                torch.tensor(float('nan'), device=y_o.device))
+        return f, (~torch.isnan(f)).float()
 
 class HausdorffDistance(HausdorffDistanceMetric):
-    def __init__(self):
-        super().__init__(include_background=True, reduction="mean")
\ No newline at end of file
+    '''
+    Reference MONAI implementation of FastHausdorffDistance.
+    '''
+    def __init__(self, percentile=None):
+        super().__init__(include_background=True, percentile=percentile, reduction="none")
+
+
+class MetricEngine():
+    '''
+    Computes each metric once per batch with per-channel values and derives the
+    per-case mean and TC/WT/ET values from that single tensor, following MONAI's
+    "mean" reduction (NaN channels are skipped, a case with no valid channel scores 0).
+    Running sums are kept as tensors so the device is only synchronised once per batch.
+    '''
+    def __init__(self, metrics, profiler=None):
+        self.metrics = metrics
+        self.profiler = profiler if profiler is not None else Profiler(enabled=False)
+        self.sums = {}
+        self.counts = {}
+
+    def __call__(self, y_pred, y):
+        '''
+        :return: one list per case of [metric_name, {'mean', 'TC', 'WT', 'ET'}] pairs
+        '''
+        batch_size = y_pred.shape[0]
+        case_results = [[] for _ in range(batch_size)]
+        for metric, metric_name in self.metrics:
+            with self.profiler.stage(f'metric/{metric_name}', cases=batch_size):
+                values, not_nans = metric(y_pred=y_pred, y=y)
+                values, valid = self.reduce(values, not_nans)
+                self.update(metric_name, values, valid)
+                values = values.cpu().tolist()
+            for case, case_values in enumerate(values):
+                results = {'mean': case_values[0]}
+                results.update(zip(REGIONS, case_values[1:]))
+                case_results[case].append([metric_name, results])
+        return case_results
+
+    @staticmethod
+    def reduce(values, not_nans):
+        '''
+        Turns [batch, channel] metric values into [batch, 1 + channel] values holding
+        the per-case mean followed by every channel, together with their validity mask.
+        '''
+        valid = not_nans > 0
+        values = torch.where(valid, values, torch.zeros_like(values))
+        channel_count = valid.sum(dim=1, keepdim=True)
+        mean = torch.where(channel_count > 0,
+                values.sum(dim=1, keepdim=True) / channel_count.clamp(min=1).to(values.dtype),
+                torch.zeros_like(channel_count, dtype=values.dtype))
+        return torch.cat([mean, values], dim=1), torch.cat([channel_count > 0, valid], dim=1)
+
+    def update(self, metric_name, values, valid):
+        values = values.double() * valid
+        if metric_name not in self.sums:
+            self.sums[metric_name] = torch.zeros(values.shape[1], dtype=torch.float64, device=values.device)
+            self.counts[metric_name] = torch.zeros(values.shape[1], dtype=torch.int64, device=values.device)
+        self.sums[metric_name] += values.sum(dim=0)
+        self.counts[metric_name] += valid.sum(dim=0)
+
+    def state(self):
+        '''
+        :return: running sums and counts of every metric, to be merged into another engine
+        '''
+        return {metric_name: {'sums': self.sums[metric_name].cpu().tolist(),
+                'counts': self.counts[metric_name].cpu().tolist()} for metric_name in self.sums}
+
+    def merge(self, state):
+        for metric_name, partial in state.items():
+            sums = torch.tensor(partial['sums'], dtype=torch.float64)
+            counts = torch.tensor(partial['counts'], dtype=torch.int64)
+            if metric_name not in self.sums:
+                self.sums[metric_name] = torch.zeros_like(sums)
+                self.counts[metric_name] = torch.zeros_like(counts)
+            self.sums[metric_name] += sums.to(self.sums[metric_name].device)
+            self.counts[metric_name] += counts.to(self.counts[metric_name].device)
+        return self
+
+    def aggregate(self):
+        '''
+        :return: {metric_name: {'mean', 'TC', 'WT', 'ET'}} averaged over the valid cases seen so far
+        '''
+        aggregates = {}
+        for metric_name in self.sums:
+            averages = (self.sums[metric_name] / self.counts[metric_name].clamp(min=1).double()).cpu().tolist()
+            aggregates[metric_name] = dict(zip(['mean'] + REGIONS, averages))
+        return aggregates
+
+    def close(self):
+        for metric, _ in self.metrics:
+            if hasattr(metric, 'close'):
+                metric.close()
+
+
+def hausdorff_parity(y_pred, y, percentiles=(None, 95)):
+    '''
+    Compares FastHausdorffDistance against the MONAI reference on the same inputs.
+    :return: {metric_name: {'max_abs_difference', 'mismatches'}}
+    '''
+    parity = {}
+    for percentile in percentiles:
+        fast, _ = FastHausdorffDistance(percentile=percentile)(y_pred=y_pred, y=y)
+        reference, _ = HausdorffDistance(percentile=percentile)(y_pred=y_pred.float(), y=y.float())
+        reference = reference.double()
+        finite = torch.isfinite(fast) & torch.isfinite(reference)
+        difference = (fast - reference).abs()[finite]
+        name = 'HausdorffDistanceMetric' if percentile is None else f'HausdorffDistance{percentile}Metric'
+        parity[name] = {
+            'max_abs_difference': difference.max().item() if difference.numel() else 0.0,
+            'mismatches': int((~torch.isclose(fast, reference, rtol=0, atol=1e-6, equal_nan=True)).sum()),
+        }
+    return parity
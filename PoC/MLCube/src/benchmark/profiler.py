@@ -0,0 +1,181 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import resource
+import time
+from monai.transforms import Transform
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def memory_status():
+    '''
+    :return: current and high-water mark RSS of this process in kilobytes, or None where
+        /proc is not available
+    '''
+    try:
+        with open('/proc/self/status', 'r') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(fields['VmRSS'].split()[0]), int(fields['VmHWM'].split()[0])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def reset_peak_rss():
+    '''
+    Resets the VmHWM high-water mark to the current RSS (Linux 4.0+).
+    :return: whether it could be reset
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class Profiler():
+    '''
+    Records wall time, call count and processed cases for named pipeline stages, and
+    the peak RSS reached while each stage ran along with its increase over the RSS at
+    the start of the stage. A disabled profiler records nothing.
+    Peaks come from the VmHWM high-water mark, reset when a stage starts. Stages may be
+    nested: the peak seen so far is credited to every open stage before each reset.
+    Where the mark can't be reset (e.g. outside Linux) no memory is recorded.
+    Resetting the mark also resets ru_maxrss, so the peak of the whole run is kept here.
+    '''
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = OrderedDict()
+        self._open = []
+        # Peak before the first reset, in kilobytes
+        self._peak = peak_rss_mb() * 1024
+
+    @contextmanager
+    def stage(self, name, cases=1):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        self.__enter_stage__()
+        try:
+            yield
+        finally:
+            memory = self.__exit_stage__()
+            self.record(name, time.perf_counter() - start, cases, memory)
+
+    def __fold_peak__(self):
+        status = memory_status()
+        if status is not None:
+            self._peak = max(self._peak, status[1])
+            for frame in self._open:
+                if frame is not None:
+                    frame['peak'] = max(frame['peak'], status[1])
+        return status
+
+    def __enter_stage__(self):
+        status = self.__fold_peak__()
+        if status is None or not reset_peak_rss():
+            self._open.append(None)
+            return
+        self._open.append({'start': status[0], 'peak': status[0]})
+
+    def __exit_stage__(self):
+        '''
+        :return: (peak RSS, peak increase) of the stage in kilobytes, or None
+        '''
+        self.__fold_peak__()
+        frame = self._open.pop()
+        if frame is None:
+            return None
+        return frame['peak'], frame['peak'] - frame['start']
+
+    def peak_rss_mb(self):
+        '''
+        :return: peak RSS of the process since it started, including the peaks of every stage
+        '''
+        self.__fold_peak__()
+        return max(self._peak / 1024, peak_rss_mb())
+
+    def iterate(self, iterable, name):
+        '''
+        Yields from iterable, timing every item fetch as the given stage.
+        '''
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            if self.enabled:
+                self.__enter_stage__()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                if self.enabled:
+                    self.__exit_stage__()
+                return
+            if self.enabled:
+                self.record(name, time.perf_counter() - start, memory=self.__exit_stage__())
+            yield item
+
+    def record(self, name, elapsed, cases=1, memory=None):
+        '''
+        :param memory: (peak RSS, peak increase) of this call in kilobytes
+        '''
+        stats = self.stages.setdefault(name, {'calls': 0, 'cases': 0, 'total_s': 0.0})
+        stats['calls'] += 1
+        stats['cases'] += cases
+        stats['total_s'] += elapsed
+        if memory is not None:
+            stats['peak_rss_mb'] = max(stats.get('peak_rss_mb', 0.0), memory[0] / 1024)
+            stats['peak_rss_increase_mb'] = max(stats.get('peak_rss_increase_mb', 0.0), memory[1] / 1024)
+
+    def wrap_transforms(self, transforms, prefix):
+        '''
+        Times every transform of a Compose as its own "<prefix>/<TransformName>" stage.
+        '''
+        if self.enabled:
+            transforms.transforms = tuple(
+                    TimedTransform(transform, self, f'{prefix}/{transform_name(transform)}')
+                    for transform in transforms.transforms)
+        return transforms
+
+    def report(self):
+        stages = OrderedDict()
+        for name, stats in self.stages.items():
+            stages[name] = dict(stats)
+            stages[name]['mean_s'] = stats['total_s'] / max(stats['calls'], 1)
+            stages[name]['cases_per_s'] = stats['cases'] / stats['total_s'] if stats['total_s'] > 0 else None
+        return stages
+
+
+def transform_name(transform):
+    # Look through wrappers such as instrumented transforms
+    return type(getattr(transform, 'transform', transform)).__name__
+
+
+class TimedTransform(Transform):
+    def __init__(self, transform, profiler, name):
+        self.transform = transform
+        self.profiler = profiler
+        self.name = name
+
+    def __call__(self, data):
+        with self.profiler.stage(self.name):
+            return self.transform(data)
+
+
+def compare_reports(baseline, current, tolerance=0.1):
+    '''
+    :return: stages whose mean time grew by more than tolerance (relative) over the baseline
+    '''
+    regressions = OrderedDict()
+    for name, stats in current['stages'].items():
+        if name not in baseline['stages']:
+            continue
+        before = baseline['stages'][name]['mean_s']
+        after = stats['mean_s']
+        if before > 0 and (after - before) / before > tolerance:
+            regressions[name] = {'baseline_mean_s': before, 'mean_s': after,
+                    'change': (after - before) / before}
+    return regressions
@@ -0,0 +1,91 @@
+import json
+import os
+
+
+class ResultsWriter():
+    '''
+    Streams per-case results to an append-only JSONL file, one line per case holding
+    every metric of the case. The file is fsynced every checkpoint_interval cases, so a
+    crash loses at most that many cases, and resuming skips the cases already written.
+    '''
+    def __init__(self, path, checkpoint_interval=10, resume=False):
+        self.path = path
+        self.checkpoint_interval = checkpoint_interval
+        self.done = set()
+        if resume and os.path.isfile(path):
+            self.done = self.__recover__()
+        self.file = open(path, 'a' if resume else 'w')
+        self.pending = 0
+
+    def __recover__(self):
+        '''
+        :return: images of the cases already written, after dropping a line left half written by a crash
+        '''
+        images = set()
+        valid_size = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    case = json.loads(line)
+                except ValueError:
+                    break
+                images.add(case['image'])
+                valid_size += len(line)
+        with open(self.path, 'r+b') as f:
+            f.truncate(valid_size)
+        return images
+
+    def write(self, index, image, metrics):
+        '''
+        :param index: position of the case in the validation list
+        :param metrics: {'image', 'metric_name', 'results'} dictionaries of the case
+        '''
+        self.file.write(json.dumps({'index': index, 'image': image, 'metrics': metrics}) + '\n')
+        self.pending += 1
+        if self.pending >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.checkpoint()
+            self.file.close()
+
+
+def read_cases(path):
+    with open(path, 'r') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def finalize(jsonl_path, results_path):
+    '''
+    Writes the cases of a results JSONL file as results.json, ordered by their position in
+    the validation list. Only line offsets are kept in memory, cases are read back one at a time.
+    '''
+    offsets = []
+    with open(jsonl_path, 'rb') as f:
+        offset = 0
+        for line in f:
+            offsets.append((json.loads(line)['index'], offset))
+            offset += len(line)
+    offsets.sort()
+
+    tmp_path = results_path + '.tmp'
+    with open(jsonl_path, 'rb') as cases, open(tmp_path, 'w') as outfile:
+        # Same layout as json.dump(results, outfile, indent=4)
+        separator = '[\n'
+        for _, offset in offsets:
+            cases.seek(offset)
+            for metrics_dictionary in json.loads(cases.readline())['metrics']:
+                entry = json.dumps(metrics_dictionary, indent=4)
+                outfile.write(separator + '\n'.join('    ' + line for line in entry.split('\n')))
+                separator = ',\n'
+        outfile.write('[]' if separator == '[\n' else '\n]')
+    os.replace(tmp_path, results_path)
@@ -0,0 +1,149 @@
+import itertools
+import logging
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+logger = logging.getLogger(__name__)
+
+BLEND_MODES = ['gaussian', 'constant']
+FLOAT_BYTES = 4
+
+
+def window_starts(size, roi, overlap):
+    '''
+    :return: start offsets of the windows covering [0, size) along one axis, the last one flush with the end
+    '''
+    if size <= roi:
+        return [0]
+    stride = max(int(roi * (1 - overlap)), 1)
+    starts = list(range(0, size - roi + 1, stride))
+    if starts[-1] != size - roi:
+        starts.append(size - roi)
+    return starts
+
+
+def importance_map(roi_size, blend='gaussian', sigma_scale=0.125):
+    '''
+    Weights of the voxels of a window when blending overlapping windows, either constant
+    or a Gaussian centred on the window so predictions near its borders count less.
+    '''
+    if blend == 'constant':
+        return torch.ones(roi_size)
+    weights = np.ones(roi_size, dtype=np.float64)
+    for axis, size in enumerate(roi_size):
+        offsets = (np.arange(size) - (size - 1) / 2) / (size * sigma_scale)
+        shape = [1] * len(roi_size)
+        shape[axis] = size
+        weights = weights * np.exp(-0.5 * offsets ** 2).reshape(shape)
+    weights /= weights.max()
+    # Voxels only covered by window corners still need a usable weight
+    return torch.from_numpy(np.maximum(weights, 1e-3).astype(np.float32))
+
+
+class SlidingWindowInferer():
+    '''
+    Runs a network over whole volumes in overlapping windows of roi_size and blends
+    the window outputs.
+    Windows are visited slab by slab along the last spatial axis. Blended outputs are
+    only kept for the slab of windows in flight, and every finished range of slices is
+    post-processed and stored as bool. Memory therefore grows with the cross-section of
+    the volume instead of its size. Post-processing must act voxel by voxel (e.g.
+    Activations, AsDiscrete).
+    The number of windows sent to the network at once is bounded by batch_size and by
+    memory_budget_mb, which covers the blending buffers and the window inputs and
+    outputs but not the network activations.
+    '''
+    def __init__(self, roi_size, overlap=0.25, blend='gaussian', batch_size=1, memory_budget_mb=None,
+            sigma_scale=0.125):
+        if blend not in BLEND_MODES:
+            raise ValueError(f"Unknown blend mode: {blend}")
+        if not 0 <= overlap < 1:
+            raise ValueError(f"Overlap must be in [0, 1), got {overlap}")
+        self.roi_size = list(roi_size)
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.memory_budget = memory_budget_mb * 1024**2 if memory_budget_mb else None
+        self.weights = importance_map(self.roi_size, blend, sigma_scale)
+
+    def __call__(self, inputs, network, postprocess=None):
+        '''
+        :param inputs: [batch, channel, *spatial] tensor
+        :param network: callable mapping a batch of windows to outputs of the same spatial size
+        :param postprocess: transformations applied to every finished slab, whose output is
+            stored as bool. The blended float outputs are returned without it.
+        :return: predictions covering the whole input
+        '''
+        spatial = list(inputs.shape[2:])
+        # Pad axes shorter than the window, the padding is cropped from the predictions
+        pad = [max(roi - size, 0) for roi, size in zip(self.roi_size, spatial)]
+        if any(pad):
+            padding = []
+            for p in reversed(pad):
+                padding += [p // 2, p - p // 2]
+            inputs = F.pad(inputs, padding)
+        padded = list(inputs.shape[2:])
+        starts = [window_starts(size, roi, self.overlap) for size, roi in zip(padded, self.roi_size)]
+        planes = list(itertools.product(*starts[:-1]))
+        depth = self.roi_size[-1]
+        weights = self.weights.to(inputs.device)
+
+        predictions = None
+        buffer = None
+        weight_sum = torch.zeros(padded[:-1] + [depth], device=inputs.device)
+        batch_size = 1
+        depth_starts = starts[-1]
+        for index, z in enumerate(depth_starts):
+            windows = [plane + (z,) for plane in planes]
+            while windows:
+                chunk, windows = windows[:batch_size], windows[batch_size:]
+                patches = torch.cat([inputs[self.__window__(start)] for start in chunk])
+                outputs = network(patches).float()
+                if buffer is None:
+                    buffer = torch.zeros([inputs.shape[0], outputs.shape[1]] + padded[:-1] + [depth],
+                            device=inputs.device)
+                    batch_size = self.__patch_batch_size__(inputs, outputs, buffer, weight_sum)
+                for i, start in enumerate(chunk):
+                    region = self.__buffer_window__(start)
+                    buffer[region] += outputs[i * inputs.shape[0]:(i + 1) * inputs.shape[0]] * weights
+                    weight_sum[region[2:]] += weights
+
+            # Slices before the next depth start get no more contributions
+            finished = depth_starts[index + 1] - z if index + 1 < len(depth_starts) else depth
+            slab = buffer[..., :finished] / weight_sum[..., :finished]
+            if postprocess is not None:
+                slab = postprocess(slab).bool()
+            if predictions is None:
+                predictions = torch.zeros(list(slab.shape[:-1]) + [padded[-1]], dtype=slab.dtype,
+                        device=inputs.device)
+            predictions[..., z:z + finished] = slab
+            del slab
+            # Shift the unfinished slices to the front of the blending buffers
+            keep = depth - finished
+            buffer[..., :keep] = buffer[..., finished:].clone()
+            buffer[..., keep:] = 0
+            weight_sum[..., :keep] = weight_sum[..., finished:].clone()
+            weight_sum[..., keep:] = 0
+
+        crop = tuple(slice(p // 2, p // 2 + size) for p, size in zip(pad, spatial))
+        return predictions[(Ellipsis,) + crop]
+
+    def __window__(self, start):
+        return (slice(None), slice(None)) + tuple(
+                slice(s, s + roi) for s, roi in zip(start, self.roi_size))
+
+    def __buffer_window__(self, start):
+        # The buffer starts at the depth of the current windows
+        return self.__window__(start[:-1] + (0,))
+
+    def __patch_batch_size__(self, inputs, outputs, buffer, weight_sum):
+        if self.memory_budget is None:
+            return self.batch_size
+        fixed = (buffer.nelement() + weight_sum.nelement()) * FLOAT_BYTES
+        per_window = (inputs.shape[1] + outputs.shape[1]) * inputs.shape[0] \
+                * int(np.prod(self.roi_size)) * FLOAT_BYTES
+        batch_size = int((self.memory_budget - fixed) // per_window)
+        if batch_size < 1:
+            logger.warning(f"Sliding window inference needs {(fixed + per_window) / 1024**2:.0f} MB, "
+                    f"more than the {self.memory_budget / 1024**2:.0f} MB budget")
+        return max(1, min(self.batch_size, batch_size))
@@ -0,0 +1,261 @@
+from concurrent.futures import ProcessPoolExecutor
+import math
+import os
+import nibabel as nib
+import numpy as np
+
+QUANTILES = [0.01, 0.25, 0.5, 0.75, 0.99]
+
+
+class QuantileSketch():
+    '''
+    Mergeable quantile sketch with logarithmic buckets (DDSketch): every quantile
+    is estimated within relative_accuracy of the true value, memory grows with the
+    log of the value range instead of the number of values, and sketches of
+    different files merge exactly.
+    '''
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        self.count += values.size
+        self.zeros += int(np.count_nonzero(values == 0))
+        self.__add_to_store(self.positive, values[values > 0])
+        self.__add_to_store(self.negative, -values[values < 0])
+
+    def __add_to_store(self, store, values):
+        if values.size == 0:
+            return
+        indices, counts = np.unique(np.ceil(np.log(values) / self.log_gamma).astype(np.int64),
+                return_counts=True)
+        for index, count in zip(indices.tolist(), counts.tolist()):
+            store[index] = store.get(index, 0) + count
+
+    def merge(self, other):
+        for store, other_store in [(self.positive, other.positive), (self.negative, other.negative)]:
+            for index, count in other_store.items():
+                store[index] = store.get(index, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        return self
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return -self.__bucket_value(index)
+        seen += self.zeros
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return self.__bucket_value(index)
+        # Only reachable through floating point rounding of the rank
+        return self.__bucket_value(max(self.positive)) if self.positive else 0.0
+
+    def __bucket_value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def to_dict(self):
+        return {'relative_accuracy': self.relative_accuracy, 'zeros': self.zeros, 'count': self.count,
+                'positive': {str(k): v for k, v in self.positive.items()},
+                'negative': {str(k): v for k, v in self.negative.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['relative_accuracy'])
+        sketch.zeros = data['zeros']
+        sketch.count = data['count']
+        sketch.positive = {int(k): v for k, v in data['positive'].items()}
+        sketch.negative = {int(k): v for k, v in data['negative'].items()}
+        return sketch
+
+
+class ChannelStats():
+    '''
+    Count, min, max, mean and sum of squared deviations of one channel, merged
+    with Chan et al.'s parallel variance formula, plus a quantile sketch.
+    '''
+    def __init__(self, relative_accuracy=0.01):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.sketch = QuantileSketch(relative_accuracy)
+
+    def add(self, values):
+        values = np.asarray(values).ravel()
+        if values.size == 0:
+            return
+        other = ChannelStats(self.sketch.relative_accuracy)
+        other.count = values.size
+        other.mean = float(values.mean(dtype=np.float64))
+        other.m2 = float(np.square(values - other.mean, dtype=np.float64).sum())
+        other.min = float(values.min())
+        other.max = float(values.max())
+        other.sketch.add(values)
+        self.merge(other)
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.mean += delta * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sketch.merge(other.sketch)
+        return self
+
+    def summary(self):
+        summary = {'min': self.min, 'max': self.max, 'mean': self.mean,
+                'std': math.sqrt(self.m2 / self.count) if self.count else None}
+        for q in QUANTILES:
+            summary[f'q{int(q * 100):02d}'] = self.sketch.quantile(q)
+        summary['median'] = summary.pop('q50')
+        return summary
+
+    def to_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'm2': self.m2, 'min': self.min, 'max': self.max,
+                'sketch': self.sketch.to_dict()}
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls(data['sketch']['relative_accuracy'])
+        stats.count, stats.mean, stats.m2 = data['count'], data['mean'], data['m2']
+        stats.min, stats.max = data['min'], data['max']
+        stats.sketch = QuantileSketch.from_dict(data['sketch'])
+        return stats
+
+
+class PartitionStats():
+    '''
+    Per-channel image statistics and label voxel counts of a set of cases.
+    Partial statistics of single cases merge into the statistics of a partition.
+    '''
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.cases = 0
+        self.channels = []
+        self.labels = {}
+
+    def add_case(self, image, label, nonzero=False):
+        '''
+        :param image: channel-last image array
+        :param label: label array
+        :param nonzero: only account for non-zero image voxels
+        '''
+        self.cases += 1
+        for channel in range(image.shape[-1]):
+            if len(self.channels) <= channel:
+                self.channels.append(ChannelStats(self.relative_accuracy))
+            values = image[..., channel]
+            self.channels[channel].add(values[values != 0] if nonzero else values)
+        values, counts = np.unique(label, return_counts=True)
+        for value, count in zip(values.tolist(), counts.tolist()):
+            self.labels[int(value)] = self.labels.get(int(value), 0) + count
+
+    def merge(self, other):
+        self.cases += other.cases
+        for channel, stats in enumerate(other.channels):
+            if len(self.channels) <= channel:
+                self.channels.append(ChannelStats(self.relative_accuracy))
+            self.channels[channel].merge(stats)
+        for value, count in other.labels.items():
+            self.labels[value] = self.labels.get(value, 0) + count
+        return self
+
+    def summary(self, channel_names=None, label_names=None):
+        channel_names = channel_names or {}
+        label_names = label_names or {}
+        total_voxels = sum(self.labels.values())
+        return {
+            'cases': self.cases,
+            'input channels': {channel_names.get(channel, channel): stats.summary()
+                    for channel, stats in enumerate(self.channels)},
+            'labels': {label_names.get(value, value): count / total_voxels
+                    for value, count in sorted(self.labels.items())},
+        }
+
+    def to_dict(self):
+        return {'relative_accuracy': self.relative_accuracy, 'cases': self.cases,
+                'channels': [stats.to_dict() for stats in self.channels],
+                'labels': {str(k): v for k, v in self.labels.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls(data['relative_accuracy'])
+        stats.cases = data['cases']
+        stats.channels = [ChannelStats.from_dict(channel) for channel in data['channels']]
+        stats.labels = {int(k): v for k, v in data['labels'].items()}
+        return stats
+
+
+def case_key(image_path, label_path, nonzero=False):
+    '''
+    Identifies the partial statistics of a case by the path, size and modification time
+    of its files, so finding them again doesn't read the volumes.
+    '''
+    parts = []
+    for path in [image_path, label_path]:
+        stat = os.stat(path)
+        parts.append(f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}")
+    return '|'.join(parts + [str(int(nonzero))])
+
+
+def case_stats(image_path, label_path, nonzero=False, relative_accuracy=0.01):
+    '''
+    Computes the partial statistics of a single case, reading each volume once.
+    :return: PartitionStats of the case in dictionary form, so it can cross process boundaries
+    '''
+    stats = PartitionStats(relative_accuracy)
+    image = np.asanyarray(nib.load(image_path).dataobj)
+    if image.ndim == 3:
+        image = image[..., None]
+    label = np.asanyarray(nib.load(label_path).dataobj)
+    stats.add_case(image, label, nonzero=nonzero)
+    return stats.to_dict()
+
+
+def _case_stats_task(args):
+    return case_stats(*args)
+
+
+def partition_stats(cases, num_workers=0, nonzero=False, relative_accuracy=0.01, partials=None):
+    '''
+    Computes per-case statistics in parallel and merges them.
+    :param cases: list of (key, image path, label path)
+    :param partials: dictionary of per-case partial statistics from earlier runs, indexed by
+        key. Cases found there are not read again, new ones are added to it.
+    :return: merged PartitionStats
+    '''
+    partials = partials if partials is not None else {}
+    missing = [case for case in cases if case[0] not in partials]
+    tasks = [(image_path, label_path, nonzero, relative_accuracy) for _, image_path, label_path in missing]
+    if num_workers > 0:
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            results = list(pool.map(_case_stats_task, tasks))
+    else:
+        results = [_case_stats_task(task) for task in tasks]
+    for (key, _, _), result in zip(missing, results):
+        partials[key] = result
+
+    stats = PartitionStats(relative_accuracy)
+    for key, _, _ in cases:
+        stats.merge(PartitionStats.from_dict(partials[key]))
+    return stats
@@ -0,0 +1,58 @@
+import os
+import nibabel as nib
+import numpy as np
+
+
+def ellipsoid(shape, center, radii):
+    grid = np.ogrid[tuple(slice(0, size) for size in shape)]
+    distance = sum(((axis - c) / r) ** 2 for axis, c, r in zip(grid, center, radii))
+    return distance <= 1
+
+
+def brats_case(shape, rng):
+    '''
+    Generates a BraTS-shaped case: a 4-channel (FLAIR, T1w, t1gd, T2w) image with a
+    noisy brain ellipsoid and a label with nested edema (1), non-enhancing (2) and
+    enhancing (3) tumour regions.
+    :return: image of shape (*shape, 4) as float32, label of shape shape as uint8
+    '''
+    shape = tuple(shape)
+    center = np.array(shape) / 2
+    brain = ellipsoid(shape, center, np.array(shape) * 0.4)
+    tumour_center = center + rng.uniform(-0.1, 0.1, size=3) * np.array(shape)
+    tumour_radii = np.array(shape) * rng.uniform(0.08, 0.15)
+
+    label = np.zeros(shape, dtype=np.uint8)
+    for value, scale in [(1, 1.0), (2, 0.6), (3, 0.3)]:
+        label[ellipsoid(shape, tumour_center, tumour_radii * scale) & brain] = value
+
+    image = rng.normal(0, 0.1, size=shape + (4,)).astype(np.float32)
+    for channel in range(4):
+        image[..., channel] += brain * rng.uniform(0.5, 1.0) + label * rng.uniform(0.1, 0.3)
+        image[..., channel][~brain] = 0
+    return image * 1000, label
+
+
+def generate_partition(output_dir, num_cases, shape=(240, 240, 155), seed=0):
+    '''
+    Writes num_cases synthetic cases as NIfTI files under output_dir.
+    :return: data configuration in the partition.yaml format, with every case as validation data
+    '''
+    rng = np.random.RandomState(seed)
+    os.makedirs(os.path.join(output_dir, 'imagesTr'), exist_ok=True)
+    os.makedirs(os.path.join(output_dir, 'labelsTr'), exist_ok=True)
+    affine = np.diag([1.0, 1.0, 1.0, 1.0])
+    datalist = []
+    for case in range(num_cases):
+        image, label = brats_case(shape, rng)
+        dictionary = {'image': f'imagesTr/SYNTH_{case:04d}.nii.gz', 'label': f'labelsTr/SYNTH_{case:04d}.nii.gz'}
+        nib.save(nib.Nifti1Image(image, affine), os.path.join(output_dir, dictionary['image']))
+        nib.save(nib.Nifti1Image(label, affine), os.path.join(output_dir, dictionary['label']))
+        datalist.append(dictionary)
+    return {
+        'description': 'Synthetic BraTS-shaped partition',
+        'file format': 'nifti',
+        'root_folder': output_dir,
+        'data': None,
+        'validation data': datalist,
+    }
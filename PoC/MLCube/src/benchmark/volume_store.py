@@ -0,0 +1,115 @@
+import json
+import os
+import nibabel as nib
+import numpy as np
+from monai.transforms import LoadImaged, MapTransform
+
+# Value of "file format" in partition files that point to a volume store
+FILE_FORMAT = 'raw'
+HEADER_SUFFIX = '.json'
+DATA_SUFFIX = '.raw'
+
+
+def header_path(path):
+    '''
+    :return: volume store header path for a NIfTI path
+    '''
+    for suffix in ['.nii.gz', '.nii']:
+        if path.endswith(suffix):
+            return path[:-len(suffix)] + HEADER_SUFFIX
+    return path + HEADER_SUFFIX
+
+
+def data_path(path):
+    '''
+    :return: path of the raw data file a volume store header points to
+    '''
+    with open(path, 'r') as f:
+        header = json.load(f)
+    return os.path.join(os.path.dirname(path), header['data'])
+
+
+def write_volume(path, array, affine, spacing, dtype=np.float32):
+    '''
+    Writes array as raw little-endian data plus a JSON header holding its shape,
+    dtype, affine and spacing. Both files are moved into place only once complete.
+    '''
+    dtype = np.dtype(dtype).newbyteorder('<')
+    data_path = path[:-len(HEADER_SUFFIX)] + DATA_SUFFIX
+    header = {
+        'data': os.path.basename(data_path),
+        'shape': list(array.shape),
+        'dtype': dtype.str,
+        'affine': np.asarray(affine).tolist(),
+        'spacing': [float(s) for s in spacing],
+    }
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(data_path + '.tmp', 'wb') as f:
+        np.ascontiguousarray(array, dtype=dtype).tofile(f)
+    os.replace(data_path + '.tmp', data_path)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(header, f)
+    os.replace(path + '.tmp', path)
+
+
+def read_volume(path):
+    '''
+    Maps a stored volume without reading it. The array is copy-on-write, so
+    slicing (e.g. CenterSpatialCropd) returns views and in-place transforms never
+    touch the file, while the OS page cache is shared between processes.
+    :return: array, meta data dictionary in the format of LoadImaged
+    '''
+    with open(path, 'r') as f:
+        header = json.load(f)
+    data_path = os.path.join(os.path.dirname(path), header['data'])
+    array = np.memmap(data_path, dtype=np.dtype(header['dtype']), mode='c', shape=tuple(header['shape']))
+    affine = np.array(header['affine'])
+    meta = {
+        'affine': affine,
+        'original_affine': affine.copy(),
+        'spatial_shape': np.array(header['shape'][:3]),
+        'pixdim': np.array([1.0] + header['spacing']),
+        'filename_or_obj': path,
+    }
+    return array, meta
+
+
+def convert_nifti(src, dst, dtype=np.float32):
+    '''
+    Converts a NIfTI file into a volume store entry unless an up to date one exists.
+    '''
+    if os.path.isfile(dst) and os.path.getmtime(dst) >= os.path.getmtime(src):
+        return
+    img = nib.load(src)
+    write_volume(dst, np.asanyarray(img.dataobj), img.affine, img.header.get_zooms(), dtype=dtype)
+
+
+class LoadVolumed(MapTransform):
+    '''
+    Volume store counterpart of LoadImaged.
+    '''
+    def __init__(self, keys, meta_key_postfix='meta_dict'):
+        super().__init__(keys)
+        self.meta_key_postfix = meta_key_postfix
+
+    def __call__(self, data):
+        d = dict(data)
+        for key in self.keys:
+            d[key], d[f'{key}_{self.meta_key_postfix}'] = read_volume(d[key])
+        return d
+
+
+def use_volume_store(transforms):
+    '''
+    Replaces every LoadImaged of a Compose with LoadVolumed, including those
+    wrapped by instrumentation.
+    '''
+    replaced = []
+    for transform in transforms.transforms:
+        if isinstance(transform, LoadImaged):
+            transform = LoadVolumed(keys=transform.keys)
+        elif isinstance(getattr(transform, 'transform', None), LoadImaged):
+            transform.transform = LoadVolumed(keys=transform.transform.keys)
+        replaced.append(transform)
+    transforms.transforms = tuple(replaced)
+    return transforms
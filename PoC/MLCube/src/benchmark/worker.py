@@ -0,0 +1,113 @@
+from collections import OrderedDict
+import glob
+import json
+import logging
+import os
+import socketserver
+import time
+
+logger = logging.getLogger(__name__)
+
+JOB_SUFFIX = '.json'
+RUNNING_SUFFIX = '.running'
+RESULT_SUFFIX = '.result'
+
+
+class ModelCache():
+    '''
+    Keeps up to max_models loaded models in memory, dropping the least recently used.
+    '''
+    def __init__(self, max_models=4):
+        self.max_models = max_models
+        self.models = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        '''
+        :param key: identifies the model, e.g. the hash of its weights
+        :param load: callable loading the model when it is not cached
+        '''
+        if key in self.models:
+            self.hits += 1
+            self.models.move_to_end(key)
+            return self.models[key]
+        self.misses += 1
+        model = load()
+        self.models[key] = model
+        while len(self.models) > self.max_models:
+            evicted, _ = self.models.popitem(last=False)
+            logger.info(f"Evicted model {evicted}")
+        return model
+
+
+def run_job(handle, payload):
+    '''
+    Parses and runs a job, turning any failure into a failed status so the worker keeps
+    serving. Jobs exiting (e.g. argparse rejecting their arguments) fail the same way.
+    :param payload: JSON text of the job
+    :return: job status dictionary
+    '''
+    start = time.perf_counter()
+    try:
+        job = json.loads(payload)
+    except ValueError as err:
+        result = {'status': 'failed', 'error': f"Invalid job: {err}"}
+    else:
+        try:
+            result = {'status': 'done', 'result': handle(job)}
+        except (Exception, SystemExit) as err:
+            logger.exception(err)
+            result = {'status': 'failed', 'error': repr(err)}
+    result['elapsed_s'] = time.perf_counter() - start
+    return result
+
+
+def serve_queue(queue_dir, handle, poll_interval=1.0):
+    '''
+    Runs the jobs written to queue_dir in name order, forever.
+    A job is a "<name>.json" file, written elsewhere and moved into queue_dir so it never
+    shows up half written. The worker renames it to "<name>.running" while it runs and
+    writes its status to "<name>.result" when it is done.
+    '''
+    os.makedirs(queue_dir, exist_ok=True)
+    logger.info(f"Waiting for jobs in {queue_dir}")
+    while True:
+        jobs = sorted(glob.glob(os.path.join(queue_dir, '*' + JOB_SUFFIX)))
+        if not jobs:
+            time.sleep(poll_interval)
+            continue
+        for job_path in jobs:
+            name = job_path[:-len(JOB_SUFFIX)]
+            try:
+                os.rename(job_path, name + RUNNING_SUFFIX)
+            except FileNotFoundError:
+                # Claimed by another worker
+                continue
+            with open(name + RUNNING_SUFFIX, 'rb') as f:
+                payload = f.read()
+            result = run_job(handle, payload)
+            tmp_path = name + RESULT_SUFFIX + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(result, f, indent=4)
+            os.replace(tmp_path, name + RESULT_SUFFIX)
+            os.remove(name + RUNNING_SUFFIX)
+            logger.info(f"Job {os.path.basename(name)} {result['status']} in {result['elapsed_s']:.1f}s")
+
+
+def serve_socket(socket_path, handle):
+    '''
+    Runs the jobs sent to a unix socket, forever. A client sends one job as a line of JSON
+    and receives its status as a line of JSON. Jobs run one at a time.
+    '''
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    class JobHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            result = run_job(handle, self.rfile.readline())
+            self.wfile.write((json.dumps(result) + '\n').encode())
+
+    with socketserver.UnixStreamServer(socket_path, JobHandler) as server:
+        logger.info(f"Waiting for jobs on {socket_path}")
+        server.serve_forever()
@@ -1,11 +1,25 @@
 import yaml
 import torch
+import torch.distributed as dist
 # from model.model import Architecture
-from benchmark.metrics import Metrics
-from benchmark.dataset import DataSet
+from benchmark.metrics import Metrics, MetricEngine, hausdorff_parity
+from benchmark.distributed import all_gather_objects, shard_indices
+from benchmark.manifest import PartitionManifest, partition_entries, write_manifest
+from benchmark.results import ResultsWriter, finalize, read_cases
+from benchmark.dataset import CompactDataSet, DataSet, PersistentDataSet, StreamingDataSet
+from benchmark.cache import PreprocessingCache, file_sha1, transforms_key
+from benchmark.statistics import case_key, partition_stats
+from benchmark import volume_store
 # from model.transforms import Tranforms
-from benchmark.dataloader import DataLoader
+from benchmark.dataloader import DataLoader, PrefetchLoader
+from benchmark.fine_tuning import fine_tune, state_dict_copy
+from benchmark.inference import InferenceEngine, configure_threads, inference_context
+from benchmark.sliding_window import SlidingWindowInferer
+from benchmark.worker import ModelCache, serve_queue, serve_socket
+from benchmark.profiler import Profiler, compare_reports
+from benchmark.synthetic import brats_case, generate_partition
 import importlib.util
+import multiprocessing
 import json
 import os
 import numpy as np
@@ -14,160 +28,463 @@ import logging
 import logging.config
 from enum import Enum
 import sys
+import time
 
 logger = logging.getLogger(__name__)
 
+# libyaml's loader parses large configuration files much faster, when PyYAML was built with it
+YAML_LOADER = getattr(yaml, 'CFullLoader', yaml.FullLoader)
+
 #Check device
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 
 class Task(str, Enum):
     scenario_1 = 'scenario_1'
+    preprocess = 'preprocess'
+    benchmark = 'benchmark'
+    statistics = 'statistics'
+    serve = 'serve'
+    evaluate_models = 'evaluate_models'
+    scenario_2 = 'scenario_2'
+
+
+class LoadedModel():
+    '''
+    Model architecture with its weights, inference engine and the model owner's
+    transforms module. Long-lived workers load it once and share it between evaluations.
+    '''
+    def __init__(self, model_config):
+        # Import model modules
+        model = import_module('model.model',
+                os.path.join(model_config['root_folder'], 'model.py'))
+        self.transforms = import_module('model.transforms',
+                os.path.join(model_config['root_folder'], 'transforms.py'))
+
+        # Set the thread pools before any parallel work starts
+        inference_config = model_config.get('inference') or {}
+        configure_threads(inference_config.get('threads'), inference_config.get('interop_threads'))
+
+        # Load model architecture
+        self.model = model.Architecture().to(device)
+        # Load model weights, benchmark runs may use the randomly initialised architecture
+        if model_config['weights'] is not None:
+            model_weights_file = os.path.join(model_config['root_folder'], model_config['weights'])
+            self.model.load_state_dict(torch.load(model_weights_file, map_location=device))
+        self.model.eval()
+        # Optimized inference as configured by the model owner, guarded against the eager model
+        self.inference_config = inference_config
+        self.reset_engine()
+
+    def reset_engine(self):
+        '''
+        Drops the optimized model, which has to be rebuilt once the weights change.
+        '''
+        self.engine = InferenceEngine(self.model, self.inference_config, device)
+
+
+def model_key(model_config):
+    '''
+    Identifies a loaded model by the hashes of its weights and code and its inference settings.
+    '''
+    root_folder = model_config['root_folder']
+    hashes = [file_sha1(os.path.join(root_folder, name)) for name in ['model.py', 'transforms.py']]
+    if model_config['weights'] is not None:
+        hashes.append(file_sha1(os.path.join(root_folder, model_config['weights'])))
+    hashes.append(json.dumps(model_config.get('inference'), sort_keys=True))
+    return '-'.join(hashes)
+
+
+def sliding_window(model_config):
+    return (model_config.get('inference') or {}).get('sliding_window') or {}
+
+
+def preprocessing_names(model_config):
+    '''
+    :return: preprocessing transformation names of the model, without the center crop
+        when sliding window inference covers the whole volume
+    '''
+    names = model_config['scenario_1']['preprocessing_tranformations']
+    if sliding_window(model_config).get('enabled'):
+        names = [name for name in names if name != 'CenterSpatialCropd']
+    return names
+
+
+def split_partition(data_config, validation_fraction):
+    '''
+    Applies benchmark_'s default validation split. The split is drawn on entry indices,
+    so only the selected entries of a manifest are ever read.
+    :return: (entries, shuffled indices) of the validation cases and of the remaining training cases
+    '''
+    if data_config['validation data'] is not None:
+        validation = data_config['validation data']
+        training = data_config['data'] or []
+        return (validation, np.random.permutation(len(validation))), \
+                (training, np.random.permutation(len(training)))
+
+    partition = data_config['data']
+    indices = np.random.permutation(len(partition))
+    val_length = int(len(partition) * float(validation_fraction))
+    return (partition, indices[:val_length]), (partition, indices[val_length:])
+
+
+def make_datalist(partition, indices, root_folder):
+    '''
+    :return: list of images, labels of the given entries, data_config is left untouched
+    '''
+    datalist = []
+    for i in indices:
+        dictionary = partition[int(i)]
+        datalist.append({key: os.path.join(root_folder, value) for key, value in dictionary.items()})
+    return datalist
+
+
+def load_partition(data_config, benchmark_config):
+    '''
+    Loads dataset from data configuration file for a particular partition id.
+    :return: list of images, labels of the validation cases
+    '''
+    (partition, indices), _ = split_partition(data_config, benchmark_config['scenario_1']['validation_fraction'])
+    return make_datalist(partition, indices, data_config['root_folder'])
+
+
+def load_data_config(data_parameters_file):
+    '''
+    Reads the data configuration file, opening the JSONL manifests it points to.
+    '''
+    with open(data_parameters_file, 'r') as f:
+        data_config = yaml.load(f, Loader=YAML_LOADER)
+    for partition in ['data', 'validation data']:
+        data_config[partition] = partition_entries(data_config, partition, data_parameters_file)
+    return data_config
+
+
+def cached_dataset(datalist, transforms, benchmark_config):
+    '''
+    Preprocesses and caches the whole datalist in memory, in the compact format if configured.
+    '''
+    compact_config = benchmark_config['scenario_1'].get('compact_cache') or {}
+    if compact_config.get('enabled'):
+        return CompactDataSet(datalist, transforms,
+                image_dtype=compact_config.get('image_dtype', 'float16'),
+                label_format=compact_config.get('label_format', 'bits'))
+    return DataSet(datalist, transforms)
 
 
 class Scenario1():
-    def __init__(self, benchmark_config, data_config, model_config, output_folder):
+    def __init__(self, benchmark_config, data_config, model_config, output_folder, loaded_model=None,
+            rank=0, world_size=1):
 
         self.data_config = data_config
         self.model_config = model_config
         self.benchmark_config = benchmark_config
+        # Stage timings are only recorded when a benchmark run enables the profiler
+        self.profiler = Profiler(enabled=False)
+        # Shard of the validation cases evaluated by this process
+        self.rank = rank
+        self.world_size = world_size
 
         # Get random seed from benchmark_ configuration file
         np.random.seed(seed=benchmark_config['random_seed'])
 
-        # Import model modules
-        model = import_module('model.model',
-                os.path.join(model_config['root_folder'], 'model.py'))
-        self.transforms = import_module('model.transforms',
-                os.path.join(model_config['root_folder'], 'transforms.py'))
-
-        # Load model architecture
-        self.model = model.Architecture().to(device)
-        # Load model weights
-        model_weights_file = os.path.join(model_config['root_folder'], model_config['weights'])
-        self.model.load_state_dict(torch.load(model_weights_file))
+        # Load model, unless a worker already has it loaded
+        if loaded_model is None:
+            loaded_model = LoadedModel(model_config)
+        self.transforms = loaded_model.transforms
+        self.model = loaded_model.model
+        self.engine = loaded_model.engine
+        # Whole-volume inference in windows of the model crop size instead of a center crop
+        sliding_window_config = sliding_window(model_config)
+        self.inferer = None
+        if sliding_window_config.get('enabled'):
+            # Without the center crop volumes keep their own shapes and can't be collated into batches
+            loader_config = self.benchmark_config['scenario_1'].get('data_loader') or {}
+            if loader_config.get('batch_size', 1) > 1:
+                raise ValueError("Sliding window inference needs data_loader batch_size 1, "
+                        f"got {loader_config['batch_size']}")
+            self.inferer = SlidingWindowInferer(model_config['crop'],
+                    overlap=sliding_window_config.get('overlap', 0.25),
+                    blend=sliding_window_config.get('blend', 'gaussian'),
+                    batch_size=sliding_window_config.get('batch_size', 1),
+                    memory_budget_mb=sliding_window_config.get('memory_budget_mb'))
         # Load scenario metrics
-        self.metrics = Metrics(self.benchmark_config['scenario_1']['metrics'])
+        self.metrics = Metrics(self.benchmark_config['scenario_1']['metrics'],
+                num_workers=self.benchmark_config['scenario_1'].get('metric_workers', 0))
         self.output_folder=output_folder
         # Create scenario output folder
         os.makedirs(self.output_folder, exist_ok=True)
         # Load preprocessing transformations as specified by model owner
-        self.preprocessing_transforms = self.transforms.Tranforms(
-                self.model_config['scenario_1']['preprocessing_tranformations'])
+        self.preprocessing_names = preprocessing_names(model_config)
+        self.preprocessing_transforms = self.__build_transforms__(self.preprocessing_names)
+        self.post_processing_transforms = None
+        self.cache_footprint = None
+        self.aggregates = None
+        # Read volumes converted by the preprocess task instead of decoding NIfTI files
+        if self.data_config.get('file format') == volume_store.FILE_FORMAT:
+            volume_store.use_volume_store(self.preprocessing_transforms)
 
 
-    def __load_partition__(self):
+    def __build_transforms__(self, names):
+        # Only ask for instrumentation when enabled so model transforms without it keep working
+        if self.benchmark_config['scenario_1'].get('instrument_transforms'):
+            return self.transforms.Tranforms(names, instrument=True)
+        return self.transforms.Tranforms(names)
+
+
+    def transform_stats(self):
         '''
-        Loads dataset from data configuration file for a particular partition id.
-        Applies benchmark_'s default validation split
-        :param partition: partition id string
-        :return: list of images, labels
+        :return: per-transform call count, latency and output statistics, when instrumented
         '''
-        root_folder = self.data_config['root_folder']
-        if self.data_config['validation data'] is not None:
-            partition = self.data_config['validation data']
-            fraction = 1
-        else:
-            partition = self.data_config['data']
-            fraction = int(self.benchmark_config['scenario_1']['validation_fraction'])
+        stats = {'preprocessing': self.preprocessing_transforms.stats()}
+        if self.post_processing_transforms is not None:
+            stats['postprocessing'] = self.post_processing_transforms.stats()
+        return stats
 
-        length = len(partition)
-        indices = np.arange(length)
-        np.random.shuffle(indices)
 
-        val_length = int(length * fraction)
+    def __load_partition__(self):
+        return load_partition(self.data_config, self.benchmark_config)
 
-        val_indices = indices[:val_length]
 
-        datalist = []
-        for i in val_indices:
-            dictionary = partition[i]
-            for key in dictionary.keys():
-                dictionary[key] = os.path.join(root_folder, dictionary[key])
-            datalist.append(dictionary)
-        return datalist
+    def __build_dataset__(self, datalist):
+        '''
+        Attaches the preprocessing transformations to the datalist as configured
+        in the benchmark configuration file.
+        :return: dataset, preprocessing cache or None
+        '''
+        loader_config = self.benchmark_config['scenario_1'].get('data_loader') or {}
+        cache_config = self.benchmark_config['scenario_1'].get('cache') or {}
+        if cache_config.get('dir'):
+            # Reuse preprocessed cases from earlier evaluations of the same data and transforms
+            max_size_gb = cache_config.get('max_size_gb')
+            cache = PreprocessingCache(cache_config['dir'],
+                    transforms_key(self.preprocessing_names,
+                            os.path.join(self.model_config['root_folder'], 'transforms.py')),
+                    max_size=int(max_size_gb * 1024**3) if max_size_gb else None)
+            return PersistentDataSet(datalist, self.preprocessing_transforms, cache), cache
+        if loader_config.get('mode', 'cached') == 'streaming':
+            # Preprocess cases while the model runs instead of caching the partition up front
+            return StreamingDataSet(datalist, self.preprocessing_transforms), None
+        return cached_dataset(datalist, self.preprocessing_transforms, self.benchmark_config), None
 
 
-    def execute(self):
+    def execute(self, dataset=None):
+        '''
+        :param dataset: preprocessed validation dataset shared with other models, loaded
+            and preprocessed here when not given
+        '''
+        # Stream every case to a JSONL file as soon as it is scored
+        results_config = self.benchmark_config['scenario_1'].get('results') or {}
+        results_file = 'results.jsonl' if self.world_size == 1 else f'results.{self.rank}.jsonl'
+        writer = ResultsWriter(os.path.join(self.output_folder, results_file),
+                checkpoint_interval=results_config.get('checkpoint_interval', 10),
+                resume=results_config.get('resume', False))
 
-        # Load partition dataset
-        datalist = self.__load_partition__()
+        cache = None
+        if dataset is None:
+            # Load partition dataset
+            with self.profiler.stage('load_partition'):
+                datalist = self.__load_partition__()
+            # Every shard loads the same shuffled list and evaluates its own share of it
+            case_indices = shard_indices(len(datalist), self.rank, self.world_size)
+            datalist = [datalist[i] for i in case_indices]
+            if writer.done:
+                # Skip the cases an interrupted run already scored
+                remaining = [(i, item) for i, item in zip(case_indices, datalist) if item['image'] not in writer.done]
+                case_indices = [i for i, _ in remaining]
+                datalist = [item for _, item in remaining]
+                logger.info(f"Resuming, {len(writer.done)} cases already scored")
 
-        # Attach preprocessing transformations to dataset
-        dataset = DataSet(datalist, self.preprocessing_transforms)
+            # Attach preprocessing transformations to dataset
+            with self.profiler.stage('build_dataset', cases=len(datalist)):
+                dataset, cache = self.__build_dataset__(datalist)
+        else:
+            case_indices = list(range(len(dataset)))
+            if writer.done:
+                # The shared dataset keeps every case, only the ones not scored yet are loaded
+                case_indices = [i for i in case_indices if dataset.data[i]['image'] not in writer.done]
+                dataset = torch.utils.data.Subset(dataset, case_indices)
+                logger.info(f"Resuming, {len(writer.done)} cases already scored")
 
         # Create data loader
-        val_loader = DataLoader(dataset)
-
-        metric_values = []
-        metric_values_tc = []
-        metric_values_wt = []
-        metric_values_et = []
-
-        self.model.eval()
+        loader_config = self.benchmark_config['scenario_1'].get('data_loader') or {}
+        if loader_config.get('num_threads', 0) > 0:
+            val_loader = PrefetchLoader(dataset,
+                    batch_size=loader_config.get('batch_size', 1),
+                    num_threads=loader_config['num_threads'],
+                    depth=loader_config.get('prefetch_factor', 2))
+        else:
+            val_loader = DataLoader(dataset,
+                    batch_size=loader_config.get('batch_size', 1),
+                    num_workers=loader_config.get('num_workers', 0),
+                    prefetch_factor=loader_config.get('prefetch_factor', 2))
 
-        metrics_results = []
+        scored = 0
+        metric_engine = MetricEngine(self.metrics, profiler=self.profiler)
         #Code below taken as is from MONAI's example: https://github.com/Project-MONAI/tutorials/blob/master/3d_segmentation/brats_segmentation_3d.ipynb
-        with torch.no_grad():
+        with inference_context():
             #Load post-processing tranformations
-            post_processing_transforms = self.transforms.Tranforms(
+            post_processing_transforms = self.__build_transforms__(
                     self.model_config['scenario_1']['postprocessing_transformations'])
+            self.post_processing_transforms = post_processing_transforms
+            self.profiler.wrap_transforms(post_processing_transforms, 'postprocess')
 
-            metric_sum = metric_sum_tc = metric_sum_wt = metric_sum_et = 0.0
-            metric_count = metric_count_tc = metric_count_wt = metric_count_et = 0
-            for val_data in val_loader:
+            for val_data in self.profiler.iterate(val_loader, 'load_batch'):
 
 
+                # Compact cached cases are only widened back to float32 here, one batch at a time
                 val_inputs, val_labels = (
-                    val_data["image"].to(device),
-                    val_data["label"].to(device),
+                    val_data["image"].to(device).float(),
+                    val_data["label"].to(device).float(),
                 )
+                filenames = val_data['image_meta_dict']['filename_or_obj']
+
+                if self.inferer is not None:
+                    # Post-processing runs on every finished slab, predictions are bool
+                    with self.profiler.stage('sliding_window', cases=len(filenames)):
+                        val_outputs = self.__predict__(self.engine, val_inputs, post_processing_transforms)
+                else:
+                    with self.profiler.stage('forward', cases=len(filenames)):
+                        val_outputs = self.engine(val_inputs)
+                    with self.profiler.stage('postprocess', cases=len(filenames)):
+                        val_outputs = post_processing_transforms(val_outputs)
+                with self.profiler.stage('accuracy_guard', cases=len(filenames)):
+                    val_outputs = self.engine.guard(
+                            lambda network: self.__predict__(network, val_inputs, post_processing_transforms),
+                            val_outputs, val_labels)
+
+                # Compute every metric once for the whole batch, then split it back into cases
+                case_results = metric_engine(y_pred=val_outputs, y=val_labels)
+                for filename, results in zip(filenames, case_results):
+                    metrics_dictionaries = []
+                    for metric_name, values in results:
+                        metrics_dictionary = {'image':filename,'metric_name':metric_name, 'results':values}
+                        metrics_dictionaries.append(metrics_dictionary)
+                    writer.write(case_indices[scored], filename, metrics_dictionaries)
+                    scored += 1
+        writer.close()
+        metric_engine.close()
+        results_path = writer.path
+        if self.world_size > 1:
+            # Merge the shards back into the order of the validation list
+            shards = all_gather_objects((list(read_cases(writer.path)), metric_engine.state()))
+            metric_engine = MetricEngine(self.metrics)
+            for _, state in shards:
+                metric_engine.merge(state)
+            if self.rank == 0:
+                merged = ResultsWriter(os.path.join(self.output_folder, 'results.jsonl'),
+                        checkpoint_interval=results_config.get('checkpoint_interval', 10))
+                for case in sorted((case for shard_cases, _ in shards for case in shard_cases),
+                        key=lambda case: case['index']):
+                    merged.write(case['index'], case['image'], case['metrics'])
+                merged.close()
+                results_path = merged.path
+        self.aggregates = metric_engine.aggregate()
+        for metric_name, values in self.aggregates.items():
+            logger.info(f"{metric_name} over the cases scored in this run: {values}")
+        if self.engine.enabled:
+            logger.info(f"Inference engine: {self.engine.describe()}")
+        if isinstance(dataset, CompactDataSet):
+            self.cache_footprint = dataset.footprint()
+            logger.info(f"Compact cache footprint: {self.cache_footprint}")
+        if cache is not None:
+            logger.info(f"Preprocessing cache: {cache.hits} hits, {cache.misses} misses")
+        return results_path
+
+    def __predict__(self, network, inputs, post_processing_transforms):
+        '''
+        :return: post-processed predictions of network for inputs
+        '''
+        if self.inferer is not None:
+            return self.inferer(inputs, network, post_processing_transforms)
+        return post_processing_transforms(network(inputs))
+
+    def export_metric_results(self, results_path):
+        '''
+        Writes results.json from the per-case results JSONL file returned by execute.
+        '''
+        finalize(results_path, os.path.join(self.output_folder,'results.json'))
+        if self.benchmark_config['scenario_1'].get('instrument_transforms'):
+            with open(os.path.join(self.output_folder,'transforms_stats.json'), "w") as outfile:
+                json.dump(self.transform_stats(), outfile, indent=4)
+
+class Scenario2():
+    '''
+    Fine-tunes the model on growing fractions of the training cases and validates every
+    fine-tuned model with the scenario_1 evaluation.
+    The fractions are nested prefixes of one shuffled order, so only the cases of the
+    largest fraction are preprocessed, once, and every step trains on its prefix of them.
+    Every step restarts from an in-memory copy of the base weights, and the validation
+    cases are preprocessed once for all steps.
+    '''
+    def __init__(self, benchmark_config, data_config, model_config, output_folder):
+        self.benchmark_config = benchmark_config
+        self.data_config = data_config
+        self.model_config = model_config
+        self.output_folder = output_folder
+        self.config = benchmark_config['scenario_2']
+        os.makedirs(self.output_folder, exist_ok=True)
+
+        # Get random seed from benchmark_ configuration file
+        np.random.seed(seed=benchmark_config['random_seed'])
+
+        self.loaded_model = LoadedModel(model_config)
+        self.base_state = state_dict_copy(self.loaded_model.model)
+        # Validation runs the scenario_1 path with the scenario_2 metrics and split
+        self.validation_config = dict(benchmark_config)
+        self.validation_config['scenario_1'] = dict(benchmark_config['scenario_1'],
+                metrics=self.config['metrics'], validation_fraction=self.config['validation_fraction'])
+
+    def __build_dataset__(self, datalist, names):
+        transforms = self.loaded_model.transforms.Tranforms(names)
+        if self.data_config.get('file format') == volume_store.FILE_FORMAT:
+            volume_store.use_volume_store(transforms)
+        return cached_dataset(datalist, transforms, self.validation_config)
+
+    def execute(self):
+        root_folder = self.data_config['root_folder']
+        (validation, validation_indices), (training, training_indices) = split_partition(
+                self.data_config, self.config['validation_fraction'])
+        fine_tuning = self.config['fine_tuning']
+        fractions = sorted(fine_tuning['percentage_of_data_used_for_each_fine_tune'])
+        largest = int(len(training_indices) * fractions[-1])
+
+        # Model owners may train on other transformations than they evaluate on, e.g. random crops
+        training_names = (self.model_config.get('scenario_2') or self.model_config['scenario_1'])['preprocessing_tranformations']
+        training_dataset = self.__build_dataset__(
+                make_datalist(training, training_indices[:largest], root_folder), training_names)
+        validation_dataset = self.__build_dataset__(
+                make_datalist(validation, validation_indices, root_folder), preprocessing_names(self.model_config))
+
+        model = self.loaded_model.model
+        summary = []
+        for fraction in fractions:
+            cases = int(len(training_indices) * fraction)
+            model.load_state_dict(self.base_state)
+            torch.manual_seed(self.benchmark_config['random_seed'])
+            start = time.perf_counter()
+            losses = []
+            if cases > 0:
+                loader = DataLoader(torch.utils.data.Subset(training_dataset, range(cases)),
+                        batch_size=fine_tuning.get('batch_size', 1), shuffle=True)
+                losses = fine_tune(model, loader, fine_tuning['number_epochs_for_each_fine_tune'],
+                        learning_rate=fine_tuning.get('learning_rate', 1e-4),
+                        weight_decay=fine_tuning.get('weight_decay', 1e-5), device=device)
+            else:
+                logger.warning(f"No training cases for fraction {fraction}, validating the base model")
+            fine_tune_s = time.perf_counter() - start
+            self.loaded_model.reset_engine()
+
+            scenario1 = Scenario1(self.validation_config, self.data_config, self.model_config,
+                    os.path.join(self.output_folder, f'fraction_{fraction}'), loaded_model=self.loaded_model)
+            scenario1.export_metric_results(scenario1.execute(dataset=validation_dataset))
+            summary.append({'fraction': fraction, 'training_cases': cases, 'losses': losses,
+                    'fine_tune_s': fine_tune_s, 'validation': scenario1.aggregates})
+            logger.info(f"Fine-tuned on {cases} cases in {fine_tune_s:.1f}s: {scenario1.aggregates}")
+        model.load_state_dict(self.base_state)
+
+        with open(os.path.join(self.output_folder, 'scenario_2.json'), 'w') as outfile:
+            json.dump(summary, outfile, indent=4)
 
-                val_outputs = self.model(val_inputs)
-                val_outputs = post_processing_transforms(val_outputs)
-
-                for metric, metric_name in self.metrics:
-
-                    # compute overall mean dice
-                    value, not_nans = metric(y_pred=val_outputs, y=val_labels)
-                    not_nans = not_nans.item()
-                    metric_count += not_nans
-                    metric_sum += value.item() * not_nans
-                    # compute mean dice for TC
-                    value_tc, not_nans = metric(y_pred=val_outputs[:, 0:1], y=val_labels[:, 0:1])
-                    not_nans = not_nans.item()
-                    metric_count_tc += not_nans
-                    metric_sum_tc += value_tc.item() * not_nans
-                    # compute mean dice for WT
-                    value_wt, not_nans = metric(y_pred=val_outputs[:, 1:2], y=val_labels[:, 1:2])
-                    not_nans = not_nans.item()
-                    metric_count_wt += not_nans
-                    metric_sum_wt += value_wt.item() * not_nans
-                    # compute mean dice for ET
-                    value_et, not_nans = metric(y_pred=val_outputs[:, 2:3], y=val_labels[:, 2:3])
-                    not_nans = not_nans.item()
-
-                    metric_count_et += not_nans
-                    metric_sum_et += value_et.item() * not_nans
-
-
-                    metric = metric_sum / (metric_count+1e-10)
-                    metric_values.append(metric)
-                    metric_tc = metric_sum_tc / (metric_count_tc+1e-10)
-                    metric_values_tc.append(metric_tc)
-                    metric_wt = metric_sum_wt / (metric_count_wt+1e-10)
-                    metric_values_wt.append(metric_wt)
-                    metric_et = metric_sum_et / (metric_count_et+1e-10)
-                    metric_values_et.append(metric_et)
-                    
-                    metrics_dictionary = {'image':val_data['image_meta_dict']['filename_or_obj'][0],'metric_name':metric_name, 'results':{'mean':value.item(),'TC':value_tc.item(),'WT':value_wt.item(),'ET':value_et.item()}}
-                    metrics_results.append(metrics_dictionary)
-        return metrics_results
-
-    def export_metric_results(self, results):
-        with open(os.path.join(self.output_folder,'results.json'), "w") as outfile:
-            json.dump(results, outfile, indent=4)
-        outfile.close()
 
 def parse_ml_args(task_args):
     parser = argparse.ArgumentParser()
@@ -182,6 +499,33 @@ def parse_ml_args(task_args):
                         help="Data parameters values.")
     parser.add_argument('--output_dir', '--output-dir', type=str, default='results',
                         help="Output directory.")
+    parser.add_argument('--loader_mode', '--loader-mode', dest='mode', type=str, default=None,
+                        choices=['cached', 'streaming'],
+                        help="Cache the whole partition before inference or stream it. Overrides benchmark parameters file.")
+    parser.add_argument('--batch_size', '--batch-size', type=int, default=None,
+                        help="Evaluation batch size. Overrides benchmark parameters file.")
+    parser.add_argument('--num_workers', '--num-workers', type=int, default=None,
+                        help="Data loading worker processes. Overrides benchmark parameters file.")
+    parser.add_argument('--num_threads', '--num-threads', type=int, default=None,
+                        help="Data loading threads, used instead of worker processes when set. Overrides benchmark parameters file.")
+    parser.add_argument('--prefetch_factor', '--prefetch-factor', type=int, default=None,
+                        help="Batches prefetched by each worker. Overrides benchmark parameters file.")
+    parser.add_argument('--instrument_transforms', '--instrument-transforms', action='store_true', default=None,
+                        help="Record per-transform timing and output statistics. Overrides benchmark parameters file.")
+    parser.add_argument('--cache_dir', '--cache-dir', type=str, default=None,
+                        help="Persistent preprocessing cache directory. Overrides benchmark parameters file.")
+    parser.add_argument('--cache_max_size_gb', '--cache-max-size-gb', type=float, default=None,
+                        help="Preprocessing cache size limit in GB. Overrides benchmark parameters file.")
+    parser.add_argument('--resume', '--resume', action='store_true', default=None,
+                        help="Skip the cases already in results.jsonl from an interrupted run. Overrides benchmark parameters file.")
+    parser.add_argument('--shards_per_node', '--shards-per-node', type=int, default=None,
+                        help="Evaluation processes started on this host. Overrides benchmark parameters file.")
+    parser.add_argument('--num_nodes', '--num-nodes', type=int, default=None,
+                        help="Hosts sharing the evaluation. Overrides benchmark parameters file.")
+    parser.add_argument('--node_rank', '--node-rank', type=int, default=None,
+                        help="Position of this host among num_nodes. Overrides benchmark parameters file.")
+    parser.add_argument('--init_method', '--init-method', type=str, default=None,
+                        help="Rendezvous address of the process group, e.g. tcp://host:port. Overrides benchmark parameters file.")
     args = parser.parse_args(args=task_args)
 
     print("Benchmark parameters file : ", args.benchmark_parameters_file)
@@ -191,6 +535,108 @@ def parse_ml_args(task_args):
 
     return args
 
+def parse_preprocess_args(task_args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', '--data_dir', type=str, default='../workspace/data',
+                        help="Data root directory")
+    parser.add_argument('--data_parameters_file', '--data_parameters_file', type=str, default='../workspace/parameters/partition.yaml',
+                        help="Data parameters values.")
+    parser.add_argument('--output_dir', '--output-dir', type=str, default='../workspace/volume_store',
+                        help="Volume store directory.")
+    args = parser.parse_args(args=task_args)
+
+    print("Data parameters file: ", args.data_parameters_file)
+    print("Output Dir : ", args.output_dir)
+
+    return args
+
+def parse_statistics_args(task_args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', '--data_dir', type=str, default='../workspace/data',
+                        help="Data root directory")
+    parser.add_argument('--data_parameters_file', '--data_parameters_file', type=str, default='../workspace/parameters/partition.yaml',
+                        help="Data parameters values.")
+    parser.add_argument('--output_dir', '--output-dir', type=str, default='statistics',
+                        help="Output directory.")
+    parser.add_argument('--statsfile', '--statsfile', type=str, default='statistics.yaml',
+                        help="Statistics file name, written to the output directory.")
+    parser.add_argument('--num_workers', '--num-workers', type=int, default=0,
+                        help="Processes computing per-case statistics.")
+    parser.add_argument('--nonzero', '--nonzero', action='store_true',
+                        help="Only account for non-zero image voxels in the intensity statistics.")
+    args = parser.parse_args(args=task_args)
+
+    print("Data parameters file: ", args.data_parameters_file)
+    print("Output Dir : ", args.output_dir)
+
+    return args
+
+def parse_serve_args(task_args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--queue_dir', '--queue-dir', type=str, default='../workspace/jobs',
+                        help="Directory polled for job files.")
+    parser.add_argument('--socket', '--socket', type=str, default=None,
+                        help="Unix socket to accept jobs on, used instead of the job queue directory when set.")
+    parser.add_argument('--poll_interval', '--poll-interval', type=float, default=1.0,
+                        help="Seconds between job queue directory scans.")
+    parser.add_argument('--max_models', '--max-models', type=int, default=4,
+                        help="Loaded models kept in memory.")
+    args = parser.parse_args(args=task_args)
+
+    print("Job queue : ", args.socket or args.queue_dir)
+
+    return args
+
+def parse_evaluate_models_args(task_args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', '--data_dir', type=str, default='../workspace/data',
+                        help="Data root directory")
+    parser.add_argument('--model_dirs', '--model-dirs', type=str, nargs='+', required=True,
+                        help="Model directories, each holding its model.yaml.")
+    parser.add_argument('--benchmark_parameters_file', '--benchmark_parameters_file', type=str, default='../workspace/parameters/benchmark.yaml', help="Benchmark parameters file.")
+    parser.add_argument('--data_parameters_file', '--data_parameters_file', type=str, default='../workspace/parameters/partition.yaml',
+                        help="Data parameters values.")
+    parser.add_argument('--output_dir', '--output-dir', type=str, default='results',
+                        help="Output directory, results of every model go to a folder named after its model directory.")
+    parser.add_argument('--num_processes', '--num-processes', type=int, default=None,
+                        help="Models evaluated concurrently, defaults to the number of cores.")
+    args = parser.parse_args(args=task_args)
+
+    print("Benchmark parameters file : ", args.benchmark_parameters_file)
+    print("Data parameters file: ", args.data_parameters_file)
+    print("Output Dir : ", args.output_dir)
+
+    return args
+
+def parse_benchmark_args(task_args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', '--model_dir', type=str, default='../workspace/model',
+                        help="Model directory")
+    parser.add_argument('--benchmark_parameters_file', '--benchmark_parameters_file', type=str, default='../workspace/parameters/benchmark.yaml', help="Benchmark parameters file.")
+    parser.add_argument('--model_parameters_file', '--model_parameters_file', type=str, default='../workspace/model/model.yaml',
+                        help="Model parameters file. User defined.")
+    parser.add_argument('--output_dir', '--output-dir', type=str, default='benchmark',
+                        help="Output directory for the synthetic data and the report.")
+    parser.add_argument('--num_cases', '--num-cases', type=int, default=8,
+                        help="Number of synthetic cases.")
+    parser.add_argument('--shape', '--shape', type=int, nargs=3, default=[240, 240, 155],
+                        help="Spatial size of the synthetic volumes.")
+    parser.add_argument('--seed', '--seed', type=int, default=0,
+                        help="Seed of the synthetic data generator.")
+    parser.add_argument('--baseline', '--baseline', type=str, default=None,
+                        help="Report of an earlier run to check for regressions against.")
+    parser.add_argument('--tolerance', '--tolerance', type=float, default=0.1,
+                        help="Relative slowdown of a stage reported as a regression.")
+    parser.add_argument('--hausdorff_parity', '--hausdorff-parity', action='store_true',
+                        help="Also compare the Hausdorff metrics against the MONAI implementation.")
+    args = parser.parse_args(args=task_args)
+
+    print("Benchmark parameters file : ", args.benchmark_parameters_file)
+    print("Model parameters file : ", args.model_parameters_file)
+    print("Output Dir : ", args.output_dir)
+
+    return args
+
 def import_module(module_name, module_path):
     spec = importlib.util.spec_from_file_location(
             module_name, module_path)
@@ -202,21 +648,353 @@ def import_module(module_name, module_path):
 def scenario_1(task_args):
     # Read arguments
     args = parse_ml_args(task_args)
+    benchmark_config, data_config, model_config = load_scenario_1_configs(args)
+
+    sharding = benchmark_config['scenario_1'].get('sharding') or {}
+    shards_per_node = sharding.get('shards_per_node', 1)
+    world_size = sharding.get('num_nodes', 1) * shards_per_node
+    if world_size == 1:
+        scenario1 = Scenario1(benchmark_config,data_config,model_config, args.output_dir)
+        results = scenario1.execute()
+        scenario1.export_metric_results(results)
+        return
+
+    # Fork the shards of this node, nothing has run on torch thread pools yet
+    context = multiprocessing.get_context('fork')
+    threads = max(1, os.cpu_count() // shards_per_node)
+    processes = []
+    for local_rank in range(shards_per_node):
+        rank = sharding.get('node_rank', 0) * shards_per_node + local_rank
+        process = context.Process(target=_scenario_1_shard, args=(benchmark_config, data_config, model_config,
+                args.output_dir, rank, world_size, sharding.get('init_method', 'tcp://127.0.0.1:29500'), threads))
+        process.start()
+        processes.append(process)
+    for process in processes:
+        process.join()
+    failed = [rank for rank, process in enumerate(processes) if process.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"Shards {failed} of this node failed")
+
+
+def _scenario_1_shard(benchmark_config, data_config, model_config, output_dir, rank, world_size, init_method, threads):
+    '''
+    Evaluates one shard of the validation cases. Rank 0 gathers every shard and writes the results.
+    '''
+    torch.set_num_threads(threads)
+    dist.init_process_group('gloo', init_method=init_method, rank=rank, world_size=world_size)
+    try:
+        scenario1 = Scenario1(benchmark_config, data_config, model_config, output_dir,
+                rank=rank, world_size=world_size)
+        results = scenario1.execute()
+        if rank == 0:
+            scenario1.export_metric_results(results)
+    except Exception as err:
+        logger.exception(err)
+        raise
+    finally:
+        dist.destroy_process_group()
+
+
+def scenario_2(task_args):
+    # Same inputs as scenario_1
+    args = parse_ml_args(task_args)
+    benchmark_config, data_config, model_config = load_scenario_1_configs(args)
+    scenario2 = Scenario2(benchmark_config, data_config, model_config, args.output_dir)
+    scenario2.execute()
+
+
+def load_scenario_1_configs(args):
+    '''
+    Reads the benchmark, data and model configuration files and applies the argument overrides.
+    :return: benchmark_config, data_config, model_config
+    '''
     # Benchmark configuration file
-    benchmark_config = yaml.load(open(args.benchmark_parameters_file), Loader=yaml.FullLoader)
+    benchmark_config = yaml.load(open(args.benchmark_parameters_file), Loader=YAML_LOADER)
+    # Set/override the data loader settings
+    loader_config = benchmark_config['scenario_1'].get('data_loader') or {}
+    for key in ['mode', 'batch_size', 'num_workers', 'num_threads', 'prefetch_factor']:
+        if getattr(args, key) is not None:
+            loader_config[key] = getattr(args, key)
+    benchmark_config['scenario_1']['data_loader'] = loader_config
+    if args.instrument_transforms is not None:
+        benchmark_config['scenario_1']['instrument_transforms'] = args.instrument_transforms
+    # Set/override the preprocessing cache settings
+    cache_config = benchmark_config['scenario_1'].get('cache') or {}
+    if args.cache_dir is not None:
+        cache_config['dir'] = args.cache_dir
+    if args.cache_max_size_gb is not None:
+        cache_config['max_size_gb'] = args.cache_max_size_gb
+    benchmark_config['scenario_1']['cache'] = cache_config
+    # Set/override the results settings
+    results_config = benchmark_config['scenario_1'].get('results') or {}
+    if args.resume is not None:
+        results_config['resume'] = args.resume
+    benchmark_config['scenario_1']['results'] = results_config
+    # Set/override the sharding settings
+    sharding = benchmark_config['scenario_1'].get('sharding') or {}
+    for key in ['shards_per_node', 'num_nodes', 'node_rank', 'init_method']:
+        if getattr(args, key) is not None:
+            sharding[key] = getattr(args, key)
+    benchmark_config['scenario_1']['sharding'] = sharding
     # Data configuration file
-    data_config = yaml.load(open(args.data_parameters_file), Loader=yaml.FullLoader)
+    data_config = load_data_config(args.data_parameters_file)
     # Set/override the data root dir
     data_config["root_folder"] = args.data_dir
     # Model configuration file (SPECIFIED BY USER)
-    model_config = yaml.load(open(args.model_parameters_file), Loader=yaml.FullLoader)
+    model_config = yaml.load(open(args.model_parameters_file), Loader=YAML_LOADER)
     # Set/override the model root dir
     model_config["root_folder"] = args.model_dir
+    return benchmark_config, data_config, model_config
+
+
+# Preprocessed dataset and configurations inherited by the forked evaluation processes
+_shared_evaluation = {}
+
+
+def _init_evaluation_process(threads):
+    # Split the cores between the processes, model configurations can still override it
+    torch.set_num_threads(threads)
+
+
+def _evaluate_model(job):
+    model_config, output_dir = job
+    start = time.perf_counter()
+    try:
+        scenario1 = Scenario1(_shared_evaluation['benchmark_config'], _shared_evaluation['data_config'],
+                model_config, output_dir)
+        scenario1.export_metric_results(scenario1.execute(dataset=_shared_evaluation['dataset']))
+        status = 'done'
+    except Exception as err:
+        logger.exception(err)
+        status = f'failed: {err!r}'
+    return {'output_dir': output_dir, 'status': status, 'elapsed_s': time.perf_counter() - start}
+
 
-    scenario1 = Scenario1(benchmark_config,data_config,model_config, args.output_dir)
+def evaluate_models(task_args):
+    '''
+    Evaluates several models on one partition. Models whose preprocessing transformations
+    are identical share a single preprocessed copy of the validation cases, which forked
+    processes evaluating the models in parallel read without copying.
+    Results of every model go to its own results.json, a models.json summary lists them all.
+    '''
+    args = parse_evaluate_models_args(task_args)
+    benchmark_config = yaml.load(open(args.benchmark_parameters_file), Loader=YAML_LOADER)
+    # Evaluation processes are daemonic and can't start data loading or metric processes of their own
+    loader_config = benchmark_config['scenario_1'].get('data_loader') or {}
+    loader_config['num_workers'] = 0
+    benchmark_config['scenario_1']['data_loader'] = loader_config
+    benchmark_config['scenario_1']['metric_workers'] = 0
+    data_config = load_data_config(args.data_parameters_file)
+    data_config['root_folder'] = args.data_dir
+
+    # Group models by their preprocessing
+    groups = {}
+    for model_dir in args.model_dirs:
+        model_config = yaml.load(open(os.path.join(model_dir, 'model.yaml')), Loader=YAML_LOADER)
+        model_config['root_folder'] = model_dir
+        key = transforms_key(preprocessing_names(model_config), os.path.join(model_dir, 'transforms.py'))
+        output_dir = os.path.join(args.output_dir, os.path.basename(os.path.normpath(model_dir)))
+        while any(output_dir == other for jobs in groups.values() for _, other in jobs):
+            output_dir += '_'
+        groups.setdefault(key, []).append((model_config, output_dir))
+
+    num_processes = args.num_processes or os.cpu_count()
+    summary = {}
+    for jobs in groups.values():
+        model_config = jobs[0][0]
+        start = time.perf_counter()
+        transforms = import_module('model.transforms', os.path.join(model_config['root_folder'], 'transforms.py'))
+        preprocessing_transforms = transforms.Tranforms(preprocessing_names(model_config))
+        if data_config.get('file format') == volume_store.FILE_FORMAT:
+            volume_store.use_volume_store(preprocessing_transforms)
+        # Every model sees the same validation split
+        np.random.seed(seed=benchmark_config['random_seed'])
+        datalist = load_partition(data_config, benchmark_config)
+        dataset = cached_dataset(datalist, preprocessing_transforms, benchmark_config)
+        logger.info(f"Preprocessed {len(datalist)} cases for {len(jobs)} models in {time.perf_counter() - start:.1f}s")
+
+        _shared_evaluation.update(benchmark_config=benchmark_config, data_config=data_config, dataset=dataset)
+        processes = min(num_processes, len(jobs))
+        context = multiprocessing.get_context('fork')
+        with context.Pool(processes, initializer=_init_evaluation_process,
+                initargs=(max(1, os.cpu_count() // processes),)) as pool:
+            for (model_config, _), result in zip(jobs, pool.map(_evaluate_model, jobs, chunksize=1)):
+                summary[model_config['root_folder']] = result
+                logger.info(f"Model {model_config['root_folder']}: {result}")
+        _shared_evaluation.clear()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(os.path.join(args.output_dir, 'models.json'), 'w') as outfile:
+        json.dump(summary, outfile, indent=4)
+
+
+def serve(task_args):
+    '''
+    Long-lived evaluation worker. Jobs hold scenario_1 arguments, e.g.
+    {"data_parameters_file": ..., "model_dir": ..., "output_dir": ...}, and arrive through
+    a job queue directory or a unix socket. Torch and MONAI are imported once and loaded
+    models stay in memory, keyed by the hash of their weights and code, so small
+    evaluations don't pay the startup cost.
+    '''
+    args = parse_serve_args(task_args)
+    models = ModelCache(max_models=args.max_models)
+
+    def handle(job):
+        job = dict(job)
+        if 'model_dir' in job:
+            job.setdefault('model_parameters_file', os.path.join(job['model_dir'], 'model.yaml'))
+        # Jobs hold the same arguments as the scenario_1 command line
+        try:
+            job_args = parse_ml_args([f'--{key}' if value is True else f'--{key}={value}'
+                    for key, value in job.items() if value is not None and value is not False])
+        except SystemExit:
+            # argparse exits on arguments it doesn't know, the error is already printed
+            raise ValueError(f"Invalid job arguments: {sorted(job)}")
+        benchmark_config, data_config, model_config = load_scenario_1_configs(job_args)
+        loaded_model = models.get(model_key(model_config), lambda: LoadedModel(model_config))
+        scenario1 = Scenario1(benchmark_config, data_config, model_config, job_args.output_dir,
+                loaded_model=loaded_model)
+        scenario1.export_metric_results(scenario1.execute())
+        logger.info(f"Model cache: {models.hits} hits, {models.misses} misses")
+        return {'output_dir': job_args.output_dir}
+
+    if args.socket is not None:
+        serve_socket(args.socket, handle)
+    else:
+        serve_queue(args.queue_dir, handle, poll_interval=args.poll_interval)
+
+
+def preprocess(task_args):
+    '''
+    Converts every volume listed in the data configuration file into an uncompressed
+    volume store and writes a partition file pointing to it next to the volumes.
+    '''
+    args = parse_preprocess_args(task_args)
+    data_config = load_data_config(args.data_parameters_file)
+    store_config = dict(data_config)
+    store_config['file format'] = volume_store.FILE_FORMAT
+    store_config['root_folder'] = None
+    for partition in ['data', 'validation data']:
+        entries = data_config.get(partition)
+        if entries is None:
+            continue
+        store_entries = []
+        for dictionary in entries:
+            store_dictionary = {}
+            for key, path in dictionary.items():
+                store_path = volume_store.header_path(path)
+                volume_store.convert_nifti(os.path.join(args.data_dir, path),
+                        os.path.join(args.output_dir, store_path))
+                store_dictionary[key] = store_path
+            store_entries.append(store_dictionary)
+            logger.info(f"Converted {dictionary}")
+        if isinstance(entries, PartitionManifest):
+            # Keep large partitions in a manifest next to the generated partition file
+            manifest_name = os.path.basename(entries.path)
+            write_manifest(store_entries, os.path.join(args.output_dir, manifest_name))
+            store_config[partition] = manifest_name
+        else:
+            store_config[partition] = store_entries
+    with open(os.path.join(args.output_dir, 'partition.yaml'), 'w') as outfile:
+        yaml.dump(store_config, outfile, sort_keys=False)
+
+
+def statistics(task_args):
+    '''
+    Computes partition statistics (per-channel intensity range, mean, deviation and
+    quantiles, label voxel fractions) in a single pass over the volumes.
+    Per-case partial results are kept next to the statistics file, indexed by the
+    path, size and modification time of the case files, so later runs only read new
+    or changed cases.
+    '''
+    args = parse_statistics_args(task_args)
+    data_config = load_data_config(args.data_parameters_file)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    cases = []
+    for partition in ['data', 'validation data']:
+        for dictionary in data_config.get(partition) or []:
+            image_path = os.path.join(args.data_dir, dictionary['image'])
+            label_path = os.path.join(args.data_dir, dictionary['label'])
+            cases.append((case_key(image_path, label_path, args.nonzero), image_path, label_path))
+
+    partials_file = os.path.join(args.output_dir, 'statistics_partials.json')
+    partials = {}
+    if os.path.isfile(partials_file):
+        with open(partials_file, 'r') as f:
+            partials = json.load(f)
+    stats = partition_stats(cases, num_workers=args.num_workers, nonzero=args.nonzero,
+            partials=partials)
+    # Only keep the partial results of the current cases
+    with open(partials_file, 'w') as f:
+        json.dump({key: partials[key] for key, _, _ in cases}, f)
+
+    summary = stats.summary(channel_names=data_config.get('input channels'),
+            label_names=data_config.get('labels'))
+    with open(os.path.join(args.output_dir, args.statsfile), 'w') as outfile:
+        yaml.dump(summary, outfile, sort_keys=False)
+
+
+def benchmark(task_args):
+    '''
+    Runs Scenario1 on synthetic BraTS-shaped data and writes a JSON report with the
+    wall time, throughput and peak RSS of every pipeline stage.
+    '''
+    args = parse_benchmark_args(task_args)
+    benchmark_config = yaml.load(open(args.benchmark_parameters_file), Loader=YAML_LOADER)
+    model_config = yaml.load(open(args.model_parameters_file), Loader=YAML_LOADER)
+    model_config["root_folder"] = args.model_dir
+    if not os.path.isfile(os.path.join(args.model_dir, model_config['weights'])):
+        logger.warning("Model weights not found, benchmarking the randomly initialised architecture")
+        model_config['weights'] = None
+    # Keep all the work in this process so every stage is timed
+    loader_config = benchmark_config['scenario_1'].get('data_loader') or {}
+    loader_config.update({'num_workers': 0, 'num_threads': 0})
+    benchmark_config['scenario_1']['data_loader'] = loader_config
+
+    profiler = Profiler()
+    with profiler.stage('generate_data', cases=args.num_cases):
+        data_config = generate_partition(os.path.join(args.output_dir, 'data'),
+                args.num_cases, shape=args.shape, seed=args.seed)
+
+    scenario1 = Scenario1(benchmark_config, data_config, model_config,
+            os.path.join(args.output_dir, 'results'))
+    scenario1.profiler = profiler
+    profiler.wrap_transforms(scenario1.preprocessing_transforms, 'preprocess')
+    start = time.perf_counter()
     results = scenario1.execute()
+    elapsed = time.perf_counter() - start
     scenario1.export_metric_results(results)
 
+    report = {
+        'config': {
+            'num_cases': args.num_cases,
+            'shape': args.shape,
+            'data_loader': loader_config,
+            'metrics': benchmark_config['scenario_1']['metrics'],
+            'preprocessing_tranformations': model_config['scenario_1']['preprocessing_tranformations'],
+            'torch_threads': torch.get_num_threads(),
+            'device': str(device),
+            'inference': scenario1.engine.describe(),
+        },
+        'total_s': elapsed,
+        'cases_per_s': args.num_cases / elapsed,
+        'peak_rss_mb': profiler.peak_rss_mb(),
+        'compact_cache': scenario1.cache_footprint,
+        'stages': profiler.report(),
+    }
+    if args.hausdorff_parity:
+        _, label = brats_case(args.shape, np.random.RandomState(args.seed))
+        y = torch.from_numpy(np.stack([label >= 2, label >= 1, label == 3])[None])
+        report['hausdorff_parity'] = hausdorff_parity(torch.roll(y, shifts=2, dims=2), y)
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            report['regressions'] = compare_reports(json.load(f), report, args.tolerance)
+        for name, regression in report['regressions'].items():
+            logger.warning(f"Stage {name} regressed: {regression}")
+
+    with open(os.path.join(args.output_dir, 'benchmark_report.json'), 'w') as outfile:
+        json.dump(report, outfile, indent=4)
 
 
 def main():
@@ -255,6 +1033,18 @@ def main():
 
         if ml_box_args.mlcube_task == Task.scenario_1:
             scenario_1(task_args)
+        elif ml_box_args.mlcube_task == Task.preprocess:
+            preprocess(task_args)
+        elif ml_box_args.mlcube_task == Task.benchmark:
+            benchmark(task_args)
+        elif ml_box_args.mlcube_task == Task.statistics:
+            statistics(task_args)
+        elif ml_box_args.mlcube_task == Task.serve:
+            serve(task_args)
+        elif ml_box_args.mlcube_task == Task.evaluate_models:
+            evaluate_models(task_args)
+        elif ml_box_args.mlcube_task == Task.scenario_2:
+            scenario_2(task_args)
         else:
             raise ValueError(f"Unknown task: {task_args}")
     except Exception as err:
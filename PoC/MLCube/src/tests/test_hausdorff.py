@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+import torch
+
+monai_metrics = pytest.importorskip('monai.metrics')
+
+from benchmark.hausdorff import FastHausdorffDistance
+
+PERCENTILES = [None, 95]
+
+
+def reference(y_pred, y, percentile):
+    return monai_metrics.compute_hausdorff_distance(y_pred.float(), y.float(),
+            include_background=True, percentile=percentile)
+
+
+def assert_parity(y_pred, y, percentile):
+    fast, _ = FastHausdorffDistance(percentile=percentile)(y_pred=y_pred, y=y)
+    expected = reference(y_pred, y, percentile)
+    assert torch.allclose(fast, expected, rtol=0, atol=1e-6, equal_nan=True), (fast, expected)
+
+
+def random_masks(rng, shape, batch_size=2, n_class=3, density=0.2):
+    y_pred = torch.from_numpy(rng.random_sample((batch_size, n_class) + shape) < density)
+    y = torch.from_numpy(rng.random_sample((batch_size, n_class) + shape) < density)
+    return y_pred, y
+
+
+@pytest.mark.parametrize('percentile', PERCENTILES)
+def test_random_masks(percentile):
+    rng = np.random.RandomState(0)
+    for density in [0.01, 0.1, 0.5]:
+        for _ in range(10):
+            assert_parity(*random_masks(rng, (12, 10, 8), density=density), percentile)
+
+
+@pytest.mark.parametrize('percentile', PERCENTILES)
+def test_blobs(percentile):
+    rng = np.random.RandomState(1)
+    for _ in range(20):
+        y_pred = torch.zeros(1, 1, 16, 16, 16, dtype=torch.bool)
+        y = torch.zeros(1, 1, 16, 16, 16, dtype=torch.bool)
+        for mask in [y_pred, y]:
+            start = rng.randint(0, 8, size=3)
+            size = rng.randint(1, 8, size=3)
+            mask[(0, 0) + tuple(slice(s, s + n) for s, n in zip(start, size))] = True
+        assert_parity(y_pred, y, percentile)
+
+
+@pytest.mark.parametrize('percentile', PERCENTILES)
+def test_empty_masks(percentile):
+    mask = torch.zeros(1, 1, 8, 8, 8, dtype=torch.bool)
+    mask[0, 0, 2:5, 3:6, 1:4] = True
+    empty = torch.zeros_like(mask)
+    assert_parity(empty, mask, percentile)
+    assert_parity(mask, empty, percentile)
+    assert_parity(empty, empty, percentile)
+
+
+@pytest.mark.parametrize('percentile', PERCENTILES)
+@pytest.mark.parametrize('axes', [(0,), (1,), (2,), (0, 1), (0, 1, 2)])
+def test_thin_bounding_box(percentile, axes):
+    # Union bounding boxes one voxel thick along some axes, e.g. single-slice masks
+    rng = np.random.RandomState(2)
+    for _ in range(50):
+        y_pred, y = random_masks(rng, (10, 9, 8), batch_size=1, n_class=1, density=0.3)
+        keep = [slice(None)] * 3
+        for axis in axes:
+            keep[axis] = slice(4, 5)
+        thin = torch.zeros_like(y_pred)
+        index = (slice(None), slice(None)) + tuple(keep)
+        thin_pred, thin_y = thin.clone(), thin.clone()
+        thin_pred[index] = y_pred[index]
+        thin_y[index] = y[index]
+        assert_parity(thin_pred, thin_y, percentile)
+
+
+def test_worker_pool():
+    rng = np.random.RandomState(3)
+    y_pred, y = random_masks(rng, (12, 10, 8))
+    metric = FastHausdorffDistance(percentile=95, num_workers=2)
+    try:
+        pooled, _ = metric(y_pred=y_pred, y=y)
+    finally:
+        metric.close()
+    assert torch.allclose(pooled, reference(y_pred, y, 95), rtol=0, atol=1e-6, equal_nan=True)
@@ -1,4 +1,6 @@
-
+import time
+import numpy as np
+import torch
 from monai.transforms import (
     Activations,
     AsDiscrete,
@@ -16,10 +18,11 @@ from monai.transforms import (
     RandSpatialCropd,
     Spacingd,
     ToTensord,
+    Transform,
 )
 
 class Tranforms(Compose):
-    def __init__(self, tranforms):
+    def __init__(self, tranforms, instrument=False):
         self.tranform_list = []
         for tranform in tranforms:
             if 'LoadImaged' == tranform:
@@ -47,4 +50,69 @@ class Tranforms(Compose):
                     f"Unsupported tranform: {tranform}. Please add it to support it."
                 )
 
+        if instrument:
+            self.tranform_list = [InstrumentedTransform(tranform) for tranform in self.tranform_list]
+
         super().__init__(self.tranform_list)
+
+    def stats(self):
+        '''
+        :return: statistics of every transform in chain order, empty unless built with instrument=True
+        '''
+        return [tranform.stats() for tranform in self.tranform_list
+                if isinstance(tranform, InstrumentedTransform)]
+
+
+class InstrumentedTransform(Transform):
+    '''
+    Wraps a transform to record its call count, latencies and the size and dtype
+    of the arrays it outputs. Only calls made in the current process are recorded.
+    '''
+    def __init__(self, transform):
+        self.transform = transform
+        self.name = type(transform).__name__
+        self.latencies = []
+        self.outputs = {}
+
+    def __call__(self, data):
+        start = time.perf_counter()
+        output = self.transform(data)
+        self.latencies.append(time.perf_counter() - start)
+        if isinstance(output, dict):
+            for key, value in output.items():
+                self.__record_output__(key, value)
+        else:
+            self.__record_output__('output', output)
+        return output
+
+    def __record_output__(self, key, value):
+        if isinstance(value, torch.Tensor):
+            nbytes = value.element_size() * value.nelement()
+        elif isinstance(value, np.ndarray):
+            nbytes = value.nbytes
+        else:
+            return
+        previous = self.outputs.get(key, {'max_nbytes': 0})
+        self.outputs[key] = {
+            'shape': list(value.shape),
+            'dtype': str(value.dtype),
+            'nbytes': nbytes,
+            'max_nbytes': max(nbytes, previous['max_nbytes']),
+        }
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        def percentile(q):
+            if not latencies:
+                return None
+            return latencies[min(int(q / 100 * len(latencies)), len(latencies) - 1)]
+        return {
+            'transform': self.name,
+            'calls': len(latencies),
+            'total_s': sum(latencies),
+            'mean_s': sum(latencies) / len(latencies) if latencies else None,
+            'p50_s': percentile(50),
+            'p90_s': percentile(90),
+            'p99_s': percentile(99),
+            'outputs': self.outputs,
+        }
@@ -1,13 +1,17 @@
 import os
 import yaml
+import hashlib
 import typer
 import requests
 from pathlib import Path
 from yaspin import yaspin
-import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 from .config import config
 from .server import Server
+from .manifest import PrepareManifest, snapshot
+from .monitor import log_tail, run_monitored, summarize
 from .utils import get_file_sha1, init_storage, cleanup, pretty_error
 
 app = typer.Typer()
@@ -21,6 +25,16 @@ def prepare(
     data_path: str = typer.Option(
         ..., "--data_path", "-d", help="Location of the data to be prepared"
     ),
+    parallel: bool = typer.Option(
+        config["parallel_tasks"],
+        "--parallel/--sequential",
+        help="Run sanity checks and statistics concurrently after preprocessing",
+    ),
+    share_resources: bool = typer.Option(
+        config["share_resources"],
+        "--share-resources/--no-share-resources",
+        help="Include the resources used by each cube task in the registration",
+    ),
 ):
     workspace_path = str(Path(data_path).parent)
     server = Server(config["server"])
@@ -34,48 +48,127 @@ def prepare(
         text=f"Retrieving data preparation cube: '{cube_uid}'", color="green"
     ) as sp:
         prep_meta = server.get_cube_metadata(cube_uid)
-        cube_path = server.get_cube(prep_meta["url"], cube_uid)
+        cube_path, params_path = server.get_cube_files(
+            prep_meta, cube_uid, workspace_path
+        )
         sp.write("> Preparation cube download complete")
-
-        sp.text = "Checking cube MD5 hash..."
-        if get_file_sha1(cube_path) != prep_meta["sha1"]:
-            pretty_error("MD5 hash doesn't match")
+        # The manifest hash is verified while it downloads
         sp.write("> Cube MD5 hash check complete")
 
-        if prep_meta["includes_parameters"]:
-            sp.text = "Downloading parameters file..."
-            params_path = server.get_cube_params(cube_uid, workspace_path)
+        if params_path is not None:
             sp.write("> Paramaters file download complete")
 
-        sp.text = "Running Cube"
-        execute_cube(
-            cube_path, workspace=workspace_path, task="preprocess", data_path=data_path
-        )
+        params_sha1 = get_file_sha1(params_path) if params_path else None
+        manifest = PrepareManifest(workspace_path)
+        manifest.check_cube(prep_meta["sha1"], params_sha1)
+        pending = manifest.scan(data_path)
+        sp.write(f"> {len(pending)} new or changed cases to preprocess")
+
+        # Preprocess in chunks, recording progress so an interrupted run resumes
+        output_paths = cube_task_outputs(cube_path, workspace_path, "preprocess")
+        reports = {"preprocess": []}
+        chunk_size = config["prepare_chunk_size"]
+        queue = list(pending)
+        processed = 0
+        while queue:
+            chunk, queue = queue[:chunk_size], queue[chunk_size:]
+            processed += len(chunk)
+            sp.text = f"Running Cube ({processed}/{processed + len(queue)} cases)"
+            staged_path = manifest.stage(data_path, chunk)
+            before = snapshot(output_paths)
+            report = execute_cube(
+                cube_path,
+                workspace=workspace_path,
+                task="preprocess",
+                data_path=staged_path,
+            )
+            reports["preprocess"].append(report)
+            after = snapshot(output_paths)
+            outputs = [
+                path for path, mtime in after.items() if before.get(path) != mtime
+            ]
+            manifest.complete(chunk, outputs)
+            removed = [path for path in before if path not in after]
+            rewritten = [path for path in outputs if path in before]
+            invalidated = manifest.invalidate_outputs(removed + rewritten, chunk)
+            if invalidated:
+                # The cube doesn't keep the outputs of earlier cases apart, e.g. it clears
+                # them or rewrites a shared index, so the rest can't be split in chunks
+                sp.write(
+                    f"> Cube replaced outputs of {len(invalidated)} processed cases, "
+                    "preprocessing the whole data set in one run"
+                )
+                queue = manifest.case_uids
+                chunk_size = len(queue)
+            sp.write(
+                f"> Preprocessed {len(chunk)} cases ({report['wall_time_s']:.1f}s)"
+            )
+        manifest.clear_staging()
         sp.write("> Cube execution complete")
 
-        sp.text = "Running sanity checks"
-        execute_cube(cube_path, workspace=workspace_path, task="sanity_check")
-        sp.write("> Sanity checks complete")
+        if manifest.statistics_complete:
+            sp.write("> Data unchanged, reusing sanity checks and statistics")
+        else:
+            # Both tasks only read the preprocessed data, so they can run side by side
+            if parallel:
+                sp.text = "Running sanity checks and generating statistics"
+                task_reports = execute_cube_tasks(
+                    cube_path, ["sanity_check", "statistics"], workspace=workspace_path
+                )
+            else:
+                task_reports = {}
+                sp.text = "Running sanity checks"
+                task_reports["sanity_check"] = execute_cube(
+                    cube_path, workspace=workspace_path, task="sanity_check"
+                )
+                sp.text = "Generating statistics"
+                task_reports["statistics"] = execute_cube(
+                    cube_path, workspace=workspace_path, task="statistics"
+                )
+            manifest.complete_statistics()
+            for task, report in task_reports.items():
+                reports[task] = [report]
+            sp.write(
+                f"> Sanity checks complete ({task_reports['sanity_check']['wall_time_s']:.1f}s)"
+            )
+            sp.write(
+                f"> Statistics complete ({task_reports['statistics']['wall_time_s']:.1f}s)"
+            )
 
-        sp.text = "Generating statistics"
-        execute_cube(cube_path, workspace=workspace_path, task="statistics")
-        sp.write("> Statistics complete")
+        resources = {task: summarize(runs) for task, runs in reports.items()}
+        report_path = write_resource_report(workspace_path, reports, resources)
+        sp.write(f"> Resource report written to {report_path}")
 
         sp.text = "Starting registration procedure"
-        reg_path = generate_registration_info(
-            cube_path, workspace_path, params_path, cube_uid
+        reg_path, reg_sha = generate_registration_info(
+            cube_path,
+            workspace_path,
+            params_path,
+            cube_uid,
+            resources=resources if share_resources else None,
         )
     approval = registration_approval(reg_path)
     if approval:
         typer.echo("Uploading")
-        server.upload_dataset(reg_path)
+        server.upload_dataset(reg_path, reg_sha)
         typer.echo("✅ Done!")
     else:
         pretty_error("Registration operation cancelled")
     cleanup()
 
 
-def execute_cube(cube: str, **kwargs):
+def run_cube_task(cube: str, **kwargs) -> dict:
+    """Runs a cube task and waits for it to finish, streaming its output to a log
+    file and sampling the resources its processes use. Failures are left to the
+    caller, so it is safe to run from worker threads
+
+    Args:
+        cube (str): path to the cube manifest
+        kwargs: arguments passed to mlcube run, e.g. task and workspace
+
+    Returns:
+        dict: exit code, log path, wall and cpu time, peak memory and disk I/O of the task
+    """
     cmd = f"mlcube run --mlcube={cube}"
     for k, v in kwargs.items():
         cmd_arg = f"--{k}={v}"
@@ -83,11 +176,107 @@ def execute_cube(cube: str, **kwargs):
 
     splitted_cmd = cmd.split()
 
-    process = subprocess.Popen(splitted_cmd, cwd=".")
-    process.wait()
+    task = kwargs.get("task", "task")
+    os.makedirs(config["logs_storage"], exist_ok=True)
+    fd, log_path = tempfile.mkstemp(
+        prefix=f"{task}-", suffix=".log", dir=config["logs_storage"]
+    )
+    os.close(fd)
+    container_task = task if config["cube_runner"] == "docker" else None
+    return run_monitored(splitted_cmd, log_path, container_task=container_task)
+
+
+def check_cube_task(task: str, report: dict):
+    """Exits with the end of the task log if the task failed. Only call it from
+    the main thread, as it cleans up the temporary storage
+
+    Args:
+        task (str): task name
+        report (dict): report returned by run_cube_task
+    """
+    if report["returncode"] != 0:
+        typer.echo(log_tail(report["log"]))
+        pretty_error(
+            f"Cube task {task} failed with exit code {report['returncode']}, "
+            f"see {report['log']}"
+        )
+
+
+def execute_cube(cube: str, **kwargs) -> dict:
+    """Runs a cube task, exiting if it fails
+
+    Args:
+        cube (str): path to the cube manifest
+        kwargs: arguments passed to mlcube run, e.g. task and workspace
 
+    Returns:
+        dict: resource report of the task
+    """
+    report = run_cube_task(cube, **kwargs)
+    check_cube_task(kwargs.get("task", "task"), report)
+    return report
 
-def generate_registration_info(cube_path, workspace_path, params_path, cube_uid):
+
+def execute_cube_tasks(cube: str, tasks: list, **kwargs) -> dict:
+    """Runs independent cube tasks concurrently. Failures are reported once every
+    task has finished
+
+    Args:
+        cube (str): path to the cube manifest
+        tasks (list): names of the tasks to run
+        kwargs: arguments passed to mlcube run for every task
+
+    Returns:
+        dict: resource report of each task
+    """
+    with ThreadPoolExecutor(max_workers=len(tasks)) as pool:
+        futures = {
+            task: pool.submit(run_cube_task, cube, task=task, **kwargs)
+            for task in tasks
+        }
+    reports = {task: future.result() for task, future in futures.items()}
+    for task, report in reports.items():
+        check_cube_task(task, report)
+    return reports
+
+
+def cube_task_outputs(cube_path: str, workspace_path: str, task: str) -> list:
+    """Lists the output locations a cube task declares in its manifest
+
+    Args:
+        cube_path (str): path to the cube manifest
+        workspace_path (str): workspace the task runs in
+        task (str): task name
+
+    Returns:
+        list: output paths inside the workspace
+    """
+    with open(cube_path, "r") as f:
+        cube = yaml.full_load(f)
+    outputs = cube["tasks"][task].get("parameters", {}).get("outputs", {}) or {}
+    return [os.path.join(workspace_path, path) for path in outputs.values()]
+
+
+def write_resource_report(workspace_path: str, reports: dict, summary: dict) -> str:
+    """Saves the resource reports of the cube tasks of a prepare run in the workspace
+
+    Args:
+        workspace_path (str): workspace of the prepare run
+        reports (dict): reports of every run of each task
+        summary (dict): combined report of each task
+
+    Returns:
+        str: path of the report
+    """
+    path = os.path.join(workspace_path, "resource_report.yaml")
+    with open(path, "w") as f:
+        yaml.dump({"summary": summary, "runs": reports}, f)
+    return path
+
+
+def generate_registration_info(
+    cube_path, workspace_path, params_path, cube_uid, resources=None
+):
     with open(cube_path, "r") as f:
         cube = yaml.full_load(f)
 
@@ -107,13 +296,18 @@ def generate_registration_info(cube_path, workspace_path, params_path, cube_uid)
         "parameters sha1": params_sha1,
         "metadata": stats,
     }
+    if resources is not None:
+        registration["resources"] = resources
 
     out_path = os.path.join(config["tmp_storage"], cube_uid, "registration.yaml")
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
 
-    with open(out_path, "w") as f:
-        yaml.dump(registration, f)
+    # Hash the contents as they are written so the upload doesn't read them again
+    contents = yaml.dump(registration).encode()
+    with open(out_path, "wb") as f:
+        f.write(contents)
 
-    return out_path
+    return out_path, hashlib.sha1(contents).hexdigest()
 
 
 def registration_approval(registration_path: str) -> bool:
@@ -0,0 +1,93 @@
+import os
+import json
+import time
+import threading
+
+from .config import config
+
+
+class Cache:
+    def __init__(self, path: str = None, max_size: int = None):
+        """Persistent store for downloaded cube files, kept across runs and benchmarks.
+
+        Entries are identified by a key such as "<cube_uid>/mlcube.yaml" and remember
+        the sha1 and ETag of their content for revalidation. The least recently used
+        entries are evicted once the total size exceeds max_size bytes.
+
+        Args:
+            path (str, optional): cache location. Defaults to config["cache_storage"].
+            max_size (int, optional): size limit in bytes. Defaults to config["cache_max_size"].
+        """
+        self.path = path if path is not None else config["cache_storage"]
+        self.max_size = max_size if max_size is not None else config["cache_max_size"]
+        self.index_path = os.path.join(self.path, "index.json")
+        self.lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def file_path(self, key: str) -> str:
+        return os.path.join(self.path, key)
+
+    def get(self, key: str) -> dict:
+        """Looks up a cache entry and marks it as recently used
+
+        Args:
+            key (str): entry key
+
+        Returns:
+            dict: entry with "sha1", "etag" and "size", or None if not cached
+        """
+        with self.lock:
+            index = self.__read_index()
+            entry = index.get(key)
+            if entry is None or not os.path.isfile(self.file_path(key)):
+                return None
+            entry["last_used"] = time.time()
+            self.__write_index(index)
+            return entry
+
+    def put(self, key: str, sha1: str, etag: str = None):
+        """Registers the file already written at file_path(key) and evicts old entries
+
+        Args:
+            key (str): entry key
+            sha1 (str): sha1 of the file contents
+            etag (str, optional): ETag returned by the server for the file
+        """
+        with self.lock:
+            index = self.__read_index()
+            index[key] = {
+                "sha1": sha1,
+                "etag": etag,
+                "size": os.path.getsize(self.file_path(key)),
+                "last_used": time.time(),
+            }
+            self.__evict(index, keep=key)
+            self.__write_index(index)
+
+    def __evict(self, index: dict, keep: str):
+        total_size = sum(entry["size"] for entry in index.values())
+        by_age = sorted(index.items(), key=lambda item: item[1]["last_used"])
+        for key, entry in by_age:
+            if total_size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            try:
+                os.remove(self.file_path(key))
+            except FileNotFoundError:
+                pass
+            total_size -= entry["size"]
+            del index[key]
+
+    def __read_index(self) -> dict:
+        try:
+            with open(self.index_path, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def __write_index(self, index: dict):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
@@ -1 +1,21 @@
-config = {"server": "http://localhost:8000", "tmp_storage": "/tmp/mlcube"}
+import os
+
+config = {
+    "server": "http://localhost:8000",
+    "tmp_storage": "/tmp/mlcube",
+    "cache_storage": os.path.join(os.path.expanduser("~"), ".medperf", "cache"),
+    "cache_max_size": 1024 ** 3,
+    "timeout": 30,
+    "retries": 3,
+    "backoff_factor": 0.5,
+    "pool_size": 10,
+    "chunk_size": 1024 ** 2,
+    "parallel_tasks": True,
+    "prepare_chunk_size": 50,
+    "case_layout": "basename",
+    "logs_storage": os.path.join(os.path.expanduser("~"), ".medperf", "logs"),
+    "monitor_interval": 0.5,
+    # runner used by mlcube run, docker tasks are measured through their containers
+    "cube_runner": "docker",
+    "share_resources": False,
+}
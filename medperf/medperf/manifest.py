@@ -0,0 +1,266 @@
+import os
+import re
+import json
+import shutil
+
+from .config import config
+from .utils import get_file_sha1
+
+
+def case_id(relpath: str) -> str:
+    """Identifies the case a data file belongs to. With the "basename" layout files
+    sharing a name across folders (e.g. imagesTr/X.nii.gz and labelsTr/X.nii.gz) form
+    a case, with the "directory" layout every top level folder is a case
+
+    Args:
+        relpath (str): file path relative to the data path
+
+    Returns:
+        str: case identifier
+    """
+    parts = relpath.split(os.sep)
+    if config["case_layout"] == "directory" and len(parts) > 1:
+        return parts[0]
+    return parts[-1].split(".")[0]
+
+
+def owns(uid: str, path: str) -> bool:
+    """Whether an output file belongs to a case, i.e. its name contains the case
+    identifier between delimiters, so that "case_1" doesn't claim "case_10.nii.gz"
+
+    Args:
+        uid (str): case identifier
+        path (str): output file path
+
+    Returns:
+        bool: True if the file name holds the identifier
+    """
+    pattern = r"(?<![A-Za-z0-9])" + re.escape(uid) + r"(?![A-Za-z0-9])"
+    return re.search(pattern, os.path.basename(path)) is not None
+
+
+def snapshot(paths: list) -> dict:
+    """Lists every file under the given paths with its modification time
+
+    Args:
+        paths (list): files or directories
+
+    Returns:
+        dict: modification time of each file path
+    """
+    files = {}
+    for path in paths:
+        if os.path.isfile(path):
+            files[path] = os.path.getmtime(path)
+        for root, _, filenames in os.walk(path):
+            for filename in filenames:
+                file_path = os.path.join(root, filename)
+                files[file_path] = os.path.getmtime(file_path)
+    return files
+
+
+class PrepareManifest:
+    def __init__(self, workspace_path: str):
+        """Record of the input files a prepare run has processed, stored in the workspace
+        so that reruns only preprocess new or changed cases and interrupted runs resume
+
+        Args:
+            workspace_path (str): workspace of the prepare run
+        """
+        self.workspace_path = workspace_path
+        self.path = os.path.join(workspace_path, "prepare_manifest.json")
+        self.staging_path = os.path.join(workspace_path, ".medperf_staging")
+        try:
+            with open(self.path, "r") as f:
+                self.manifest = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.manifest = {}
+        self.manifest.setdefault("cube_sha1", None)
+        self.manifest.setdefault("params_sha1", None)
+        self.manifest.setdefault("statistics_complete", False)
+        self.manifest.setdefault("cases", {})
+
+    @property
+    def statistics_complete(self) -> bool:
+        return self.manifest["statistics_complete"]
+
+    @property
+    def case_uids(self) -> list:
+        return sorted(self.manifest["cases"])
+
+    def check_cube(self, cube_sha1: str, params_sha1: str):
+        """Invalidates every processed case if the cube or its parameters changed
+
+        Args:
+            cube_sha1 (str): sha1 of the cube manifest
+            params_sha1 (str): sha1 of the parameters file
+        """
+        if (self.manifest["cube_sha1"], self.manifest["params_sha1"]) != (
+            cube_sha1,
+            params_sha1,
+        ):
+            for case in self.manifest["cases"].values():
+                case["done"] = False
+            self.manifest["statistics_complete"] = False
+        self.manifest["cube_sha1"] = cube_sha1
+        self.manifest["params_sha1"] = params_sha1
+
+    def scan(self, data_path: str) -> list:
+        """Hashes the data files, skipping files whose size and modification time
+        are unchanged, and marks cases with new, changed or removed files as pending.
+        Outputs of changed or removed cases are deleted, and cases sharing any of
+        those outputs are processed again, as are cases whose outputs are missing
+
+        Args:
+            data_path (str): location of the data to be prepared
+
+        Returns:
+            list: identifiers of the cases that need preprocessing
+        """
+        stats = {}
+        for root, _, filenames in os.walk(data_path):
+            for filename in filenames:
+                file_path = os.path.join(root, filename)
+                relpath = os.path.relpath(file_path, data_path)
+                stats.setdefault(case_id(relpath), {})[relpath] = os.stat(file_path)
+
+        previous_cases = self.manifest["cases"]
+        cases = {}
+        invalidated = set(previous_cases) - set(stats)
+        for uid, case_stats in stats.items():
+            previous = previous_cases.get(
+                uid, {"files": {}, "outputs": [], "done": False}
+            )
+            files = {}
+            for relpath, stat in case_stats.items():
+                known = previous["files"].get(relpath)
+                if known and (known["size"], known["mtime"]) == (
+                    stat.st_size,
+                    stat.st_mtime,
+                ):
+                    sha1 = known["sha1"]
+                else:
+                    sha1 = get_file_sha1(os.path.join(data_path, relpath))
+                files[relpath] = {
+                    "sha1": sha1,
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime,
+                }
+            hashes = {relpath: f["sha1"] for relpath, f in files.items()}
+            previous_hashes = {
+                relpath: f["sha1"] for relpath, f in previous["files"].items()
+            }
+            if hashes != previous_hashes:
+                invalidated.add(uid)
+            elif any(
+                not os.path.exists(os.path.join(self.workspace_path, path))
+                for path in previous["outputs"]
+            ):
+                # Outputs deleted since they were produced
+                invalidated.add(uid)
+            cases[uid] = {
+                "files": files,
+                "outputs": previous["outputs"],
+                "done": previous["done"],
+            }
+
+        stale_outputs = set()
+        for uid in invalidated:
+            stale_outputs.update(previous_cases.get(uid, {"outputs": []})["outputs"])
+        for uid, case in cases.items():
+            if uid in invalidated or stale_outputs.intersection(case["outputs"]):
+                case["done"] = False
+                case["outputs"] = []
+        for relpath in stale_outputs:
+            path = os.path.join(self.workspace_path, relpath)
+            if os.path.isfile(path):
+                os.remove(path)
+
+        self.manifest["cases"] = cases
+        pending = sorted(uid for uid, case in cases.items() if not case["done"])
+        if pending or invalidated:
+            self.manifest["statistics_complete"] = False
+        return pending
+
+    def stage(self, data_path: str, case_uids: list) -> str:
+        """Builds a data folder holding only the files of the given cases. Files are
+        hard linked when possible so they stay visible inside containers
+
+        Args:
+            data_path (str): location of the data to be prepared
+            case_uids (list): cases to stage
+
+        Returns:
+            str: path of the staged data folder
+        """
+        self.clear_staging()
+        for uid in case_uids:
+            for relpath in self.manifest["cases"][uid]["files"]:
+                src = os.path.join(data_path, relpath)
+                dst = os.path.join(self.staging_path, relpath)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                try:
+                    os.link(src, dst)
+                except OSError:
+                    shutil.copy2(src, dst)
+        return self.staging_path
+
+    def clear_staging(self):
+        if os.path.isdir(self.staging_path):
+            shutil.rmtree(self.staging_path)
+
+    def complete(self, case_uids: list, outputs: list):
+        """Marks cases as processed and saves the manifest. Outputs whose name
+        holds a case identifier belong to that case, the rest to every case given
+
+        Args:
+            case_uids (list): processed cases
+            outputs (list): output files produced while processing them
+        """
+        outputs = [os.path.relpath(path, self.workspace_path) for path in outputs]
+        for uid in case_uids:
+            owned = [path for path in outputs if owns(uid, path)]
+            shared = [
+                path
+                for path in outputs
+                if not any(owns(other, path) for other in case_uids)
+            ]
+            self.manifest["cases"][uid]["done"] = True
+            self.manifest["cases"][uid]["outputs"] = owned + shared
+        self.save()
+
+    def invalidate_outputs(self, changed: list, exclude: list = ()) -> list:
+        """Marks the processed cases owning any of the changed outputs as pending.
+        Outputs change under earlier cases when a cube clears its output folder before
+        every run, or rewrites an output shared by every case such as a partition index
+
+        Args:
+            changed (list): output files that disappeared or were rewritten
+            exclude (list, optional): cases that just produced the outputs
+
+        Returns:
+            list: identifiers of the cases that need preprocessing again
+        """
+        changed = {os.path.relpath(path, self.workspace_path) for path in changed}
+        invalidated = []
+        for uid, case in self.manifest["cases"].items():
+            if uid in exclude:
+                continue
+            if case["done"] and changed.intersection(case["outputs"]):
+                case["done"] = False
+                case["outputs"] = []
+                invalidated.append(uid)
+        if invalidated:
+            self.manifest["statistics_complete"] = False
+            self.save()
+        return sorted(invalidated)
+
+    def complete_statistics(self):
+        self.manifest["statistics_complete"] = True
+        self.save()
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,352 @@
+import os
+import subprocess
+import time
+from collections import deque
+
+import psutil
+
+from .config import config
+
+
+class ProcessTreeMonitor:
+    def __init__(self, pid: int, interval: float = None):
+        """Samples a process and all its descendants for CPU time, resident memory
+        and disk I/O. Totals of processes that exit between samples are kept as last
+        seen, so short-lived children are only counted for the time they were observed.
+
+        Processes started outside the tree are not seen, tasks run by the docker runner
+        are measured by ContainerMonitor instead.
+
+        Args:
+            pid (int): root process of the tree
+            interval (float, optional): seconds between samples. Defaults to config["monitor_interval"].
+        """
+        self.root = psutil.Process(pid)
+        self.interval = interval if interval is not None else config["monitor_interval"]
+        self.processes = {}
+        self.peak_rss = 0
+        self.samples = 0
+
+    def __tree(self) -> list:
+        try:
+            return [self.root] + self.root.children(recursive=True)
+        except psutil.Error:
+            return []
+
+    def sample(self):
+        rss = 0
+        for process in self.__tree():
+            try:
+                with process.oneshot():
+                    key = (process.pid, process.create_time())
+                    cpu = process.cpu_times()
+                    rss += process.memory_info().rss
+                    # I/O counters are not available on every platform
+                    io = (
+                        process.io_counters()
+                        if hasattr(process, "io_counters")
+                        else None
+                    )
+            except psutil.Error:
+                continue
+            self.processes[key] = {
+                "cpu_time": cpu.user + cpu.system,
+                "read_bytes": io.read_bytes if io else 0,
+                "write_bytes": io.write_bytes if io else 0,
+            }
+        self.peak_rss = max(self.peak_rss, rss)
+        self.samples += 1
+
+    def report(self) -> dict:
+        """Totals over every process seen so far
+
+        Returns:
+            dict: cpu time in seconds, peak rss and bytes read and written
+        """
+        totals = {"cpu_time": 0.0, "read_bytes": 0, "write_bytes": 0}
+        for process in self.processes.values():
+            for key in totals:
+                totals[key] += process[key]
+        return {
+            "measured": "process tree",
+            "cpu_time_s": round(totals["cpu_time"], 3),
+            "peak_rss_bytes": self.peak_rss,
+            "read_bytes": totals["read_bytes"],
+            "write_bytes": totals["write_bytes"],
+            "processes": len(self.processes),
+            "samples": self.samples,
+        }
+
+
+def cgroup_paths(pid: int) -> dict:
+    """Locates the cgroup directories of a process
+
+    Args:
+        pid (int): process id
+
+    Returns:
+        dict: directory of each cgroup v1 controller, or of the v2 hierarchy under ""
+    """
+    paths = {}
+    with open(f"/proc/{pid}/cgroup", "r") as f:
+        for line in f:
+            _, controllers, path = line.rstrip("\n").split(":", 2)
+            for controller in controllers.split(","):
+                root = (
+                    "/sys/fs/cgroup"
+                    if controller == ""
+                    else f"/sys/fs/cgroup/{controller}"
+                )
+                if controller == "" and not os.path.isfile(
+                    "/sys/fs/cgroup/cgroup.controllers"
+                ):
+                    # Hybrid hierarchy, v2 is mounted apart from the v1 controllers
+                    root = "/sys/fs/cgroup/unified"
+                paths[controller] = root + path
+    return paths
+
+
+def read_fields(path: str) -> dict:
+    """Reads a flat keyed cgroup file such as memory.stat or cpu.stat"""
+    fields = {}
+    with open(path, "r") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 2:
+                fields[parts[0]] = int(parts[1])
+    return fields
+
+
+def cgroup_counters(paths: dict) -> dict:
+    """Reads the cumulative CPU time and disk I/O and the current resident memory of a
+    cgroup. Resident memory is anonymous memory, without the page cache
+
+    Args:
+        paths (dict): cgroup directories returned by cgroup_paths
+
+    Returns:
+        dict: cpu time in seconds, rss and bytes read and written
+    """
+    if "memory" in paths:
+        # cgroup v1
+        with open(os.path.join(paths["cpuacct"], "cpuacct.usage"), "r") as f:
+            cpu_time = int(f.read()) / 1e9
+        memory = read_fields(os.path.join(paths["memory"], "memory.stat"))
+        rss = memory.get("total_rss", memory.get("rss", 0))
+        read_bytes = write_bytes = 0
+        with open(
+            os.path.join(paths["blkio"], "blkio.throttle.io_service_bytes"), "r"
+        ) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[1] == "Read":
+                    read_bytes += int(parts[2])
+                elif len(parts) == 3 and parts[1] == "Write":
+                    write_bytes += int(parts[2])
+    else:
+        path = paths[""]
+        cpu_time = read_fields(os.path.join(path, "cpu.stat"))["usage_usec"] / 1e6
+        rss = read_fields(os.path.join(path, "memory.stat")).get("anon", 0)
+        read_bytes = write_bytes = 0
+        with open(os.path.join(path, "io.stat"), "r") as f:
+            for line in f:
+                for field in line.split()[1:]:
+                    key, value = field.split("=")
+                    if key == "rbytes":
+                        read_bytes += int(value)
+                    elif key == "wbytes":
+                        write_bytes += int(value)
+    return {
+        "cpu_time": cpu_time,
+        "rss": rss,
+        "read_bytes": read_bytes,
+        "write_bytes": write_bytes,
+    }
+
+
+class ContainerMonitor:
+    def __init__(self, task: str, interval: float = None):
+        """Samples the cgroups of the docker containers running a cube task, since
+        their processes run under the docker daemon rather than under mlcube run.
+        Containers started after the monitor whose command holds the task name are
+        attributed to the task. Counters are kept as last seen once a container exits.
+
+        Args:
+            task (str): cube task name
+            interval (float, optional): seconds between samples. Defaults to config["monitor_interval"].
+        """
+        self.task = task
+        self.interval = interval if interval is not None else config["monitor_interval"]
+        self.known = set(self.__running())
+        self.containers = {}
+        self.peak_rss = 0
+        self.samples = 0
+
+    def __running(self) -> dict:
+        try:
+            output = subprocess.run(
+                ["docker", "ps", "--no-trunc", "--format", "{{.ID}}\t{{.Command}}"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                universal_newlines=True,
+            ).stdout
+        except OSError:
+            return {}
+        containers = {}
+        for line in output.splitlines():
+            container_id, _, command = line.partition("\t")
+            containers[container_id] = command
+        return containers
+
+    def __cgroup_paths(self, container_id: str) -> dict:
+        try:
+            pid = subprocess.run(
+                ["docker", "inspect", "--format", "{{.State.Pid}}", container_id],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                universal_newlines=True,
+            ).stdout.strip()
+            return cgroup_paths(int(pid))
+        except (OSError, ValueError):
+            return None
+
+    def sample(self):
+        for container_id, command in self.__running().items():
+            if container_id in self.known:
+                continue
+            if self.task not in command.split():
+                # Another task running alongside, or a container started by something else
+                self.known.add(container_id)
+                continue
+            container = self.containers.setdefault(
+                container_id, {"paths": self.__cgroup_paths(container_id)}
+            )
+            if container["paths"] is None:
+                continue
+            try:
+                container.update(cgroup_counters(container["paths"]))
+            except (OSError, KeyError, ValueError):
+                # Exited, or its counters are not readable from here
+                continue
+        rss = sum(container.get("rss", 0) for container in self.containers.values())
+        self.peak_rss = max(self.peak_rss, rss)
+        self.samples += 1
+
+    def report(self) -> dict:
+        """Totals over every container of the task seen so far
+
+        Returns:
+            dict: cpu time in seconds, peak rss and bytes read and written, or None
+                for each of them when no container could be measured
+        """
+        measured = [c for c in self.containers.values() if "cpu_time" in c]
+        if not measured:
+            return not_measured(self.samples)
+        return {
+            "measured": "container",
+            "cpu_time_s": round(sum(c["cpu_time"] for c in measured), 3),
+            "peak_rss_bytes": self.peak_rss,
+            "read_bytes": sum(c["read_bytes"] for c in measured),
+            "write_bytes": sum(c["write_bytes"] for c in measured),
+            "containers": len(measured),
+            "samples": self.samples,
+        }
+
+
+def not_measured(samples: int = 0) -> dict:
+    return {
+        "measured": "not measured",
+        "cpu_time_s": None,
+        "peak_rss_bytes": None,
+        "read_bytes": None,
+        "write_bytes": None,
+        "samples": samples,
+    }
+
+
+def run_monitored(
+    cmd: list, log_path: str, interval: float = None, container_task: str = None
+) -> dict:
+    """Runs a command with its output streamed to a log file, sampling its process
+    tree, or the containers it starts, until it exits
+
+    Args:
+        cmd (list): command and arguments
+        log_path (str): file receiving stdout and stderr
+        interval (float, optional): seconds between samples. Defaults to config["monitor_interval"].
+        container_task (str, optional): measure the docker containers running this
+            task instead of the process tree
+
+    Returns:
+        dict: exit code, wall time and resource usage of the command
+    """
+    start = time.perf_counter()
+    with open(log_path, "wb") as log:
+        monitor = ContainerMonitor(container_task, interval) if container_task else None
+        process = subprocess.Popen(cmd, cwd=".", stdout=log, stderr=subprocess.STDOUT)
+        try:
+            if monitor is None:
+                monitor = ProcessTreeMonitor(process.pid, interval)
+        except psutil.Error:
+            # Exited before the first sample
+            monitor = None
+        while process.poll() is None and monitor is not None:
+            monitor.sample()
+            try:
+                process.wait(timeout=monitor.interval)
+            except subprocess.TimeoutExpired:
+                pass
+        process.wait()
+    report = {
+        "command": " ".join(cmd),
+        "returncode": process.returncode,
+        "wall_time_s": round(time.perf_counter() - start, 3),
+        "log": log_path,
+    }
+    report.update(monitor.report() if monitor is not None else not_measured())
+    return report
+
+
+def log_tail(log_path: str, lines: int = 20) -> str:
+    """Last lines of a log file, to show why a task failed"""
+    with open(log_path, "r", errors="replace") as f:
+        return "".join(deque(f, maxlen=lines))
+
+
+def summarize(reports: list) -> dict:
+    """Combines the reports of several runs of a task, e.g. preprocessing chunks
+
+    Args:
+        reports (list): reports returned by run_monitored
+
+    Returns:
+        dict: summed times and I/O and the largest peak memory, each None unless
+            measured in every run
+    """
+    summary = {
+        "runs": len(reports),
+        "wall_time_s": 0.0,
+        "cpu_time_s": 0.0,
+        "peak_rss_bytes": 0,
+        "read_bytes": 0,
+        "write_bytes": 0,
+    }
+    for report in reports:
+        for key in ["wall_time_s", "cpu_time_s", "read_bytes", "write_bytes"]:
+            if summary[key] is not None and report.get(key) is not None:
+                summary[key] += report[key]
+            else:
+                summary[key] = None
+        if (
+            summary["peak_rss_bytes"] is not None
+            and report.get("peak_rss_bytes") is not None
+        ):
+            summary["peak_rss_bytes"] = max(
+                summary["peak_rss_bytes"], report["peak_rss_bytes"]
+            )
+        else:
+            summary["peak_rss_bytes"] = None
+    for key in ["wall_time_s", "cpu_time_s"]:
+        if summary[key] is not None:
+            summary[key] = round(summary[key], 3)
+    return summary
@@ -1,14 +1,59 @@
 import requests
-from pathlib import Path
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+import shutil
 import os
 
+from .cache import Cache
 from .config import config
-from .utils import pretty_error, get_file_sha1, cleanup
+from .utils import (
+    pretty_error,
+    get_file_sha1,
+    cleanup,
+    stream_to_file,
+    MultipartFileStream,
+)
+
+
+class ServerError(Exception):
+    """Failure to retrieve a resource, raised where pretty_error can't exit
+    directly, e.g. in download threads"""
+
+
+def create_session() -> requests.Session:
+    """Creates a session with a shared keep-alive connection pool that retries
+    idempotent requests on connection errors and 5xx responses with backoff.
+    Once retries run out the last 5xx response is returned like any other failure
+
+    Returns:
+        requests.Session: configured session
+    """
+    retry = Retry(
+        total=config["retries"],
+        backoff_factor=config["backoff_factor"],
+        status_forcelist=[500, 502, 503, 504],
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=config["pool_size"],
+        pool_maxsize=config["pool_size"],
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
 
 class Server:
-    def __init__(self, server_url):
+    def __init__(
+        self, server_url, session: requests.Session = None, cache: Cache = None
+    ):
         self.server_url = server_url
+        self.session = session if session is not None else create_session()
+        self.cache = cache if cache is not None else Cache()
+        self.timeout = config["timeout"]
 
     def get_benchmark(self, benchmark_uid: str) -> dict:
         """Retrieves the benchmark specification file from the server
@@ -19,46 +64,164 @@ class Server:
         Returns:
             dict: benchmark specification
         """
-        res = requests.get(f"{self.server_url}/benchmarks/{benchmark_uid}")
+        try:
+            res = self.session.get(
+                f"{self.server_url}/benchmarks/{benchmark_uid}", timeout=self.timeout
+            )
+        except requests.RequestException as err:
+            pretty_error(f"Could not reach the server: {err}")
         if res.status_code != 200:
             pretty_error("the specified benchmark doesn't exist")
         benchmark = res.json()
         return benchmark
 
     def get_cube_metadata(self, cube_uid: str):
-        res = requests.get(f"{self.server_url}/cubes/{cube_uid}/metadata")
+        try:
+            res = self.session.get(
+                f"{self.server_url}/cubes/{cube_uid}/metadata", timeout=self.timeout
+            )
+        except requests.RequestException as err:
+            pretty_error(f"Could not reach the server: {err}")
         if res.status_code != 200:
             pretty_error("the specified cube doesn't exist")
         metadata = res.json()
         return metadata
 
-    def get_cube(self, url: str, uid: str):
-        res = requests.get(url)
-        if res.status_code != 200:
-            pretty_error("The specified cube doesn't exist")
+    def __get_cached(self, url: str, key: str, sha1: str = None) -> str:
+        """Retrieves a file through the local cache. Entries whose sha1 matches the
+        expected one are used as is, others are revalidated with their ETag.
+        Downloads are streamed to disk and hashed in the same pass
 
-        tmp_cube_path = os.path.join(config["tmp_storage"], uid)
-        if not os.path.isdir(tmp_cube_path):
-            os.mkdir(tmp_cube_path)
-        tmp_cube_manifest = os.path.join(tmp_cube_path, "mlcube.yaml")
-        open(tmp_cube_manifest, "wb+").write(res.content)
-        return tmp_cube_manifest
+        Args:
+            url (str): location of the file on the server
+            key (str): cache key of the file
+            sha1 (str, optional): expected sha1 of the file, if known
+
+        Returns:
+            str: path to the cached file, or None if the server couldn't provide it
+
+        Raises:
+            ServerError: the server is unreachable or the content doesn't match sha1
+        """
+        entry = self.cache.get(key)
+        cached_path = self.cache.file_path(key)
+        if entry is not None and sha1 is not None and entry["sha1"] == sha1:
+            return cached_path
+
+        headers = {}
+        if entry is not None and entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        try:
+            with self.session.get(
+                url, headers=headers, timeout=self.timeout, stream=True
+            ) as res:
+                if res.status_code == 304 and entry is not None:
+                    if sha1 is not None and entry["sha1"] != sha1:
+                        raise ServerError("MD5 hash doesn't match")
+                    return cached_path
+                if res.status_code != 200:
+                    return None
+
+                os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+                content_sha1 = stream_to_file(res, cached_path, sha1)
+                if content_sha1 is None:
+                    raise ServerError("MD5 hash doesn't match")
+                self.cache.put(key, content_sha1, res.headers.get("ETag"))
+        except requests.RequestException as err:
+            raise ServerError(f"Could not reach the server: {err}")
+        return cached_path
+
+    def get_cube(self, url: str, uid: str, sha1: str = None):
+        """Retrieves the cube manifest, verifying its hash while it downloads
+
+        Args:
+            url (str): location of the cube manifest
+            uid (str): uid of the cube
+            sha1 (str, optional): expected sha1 of the manifest
+
+        Returns:
+            str: path to the cube manifest
+
+        Raises:
+            ServerError: the manifest couldn't be retrieved
+        """
+        cube_manifest = self.__get_cached(url, f"{uid}/mlcube.yaml", sha1)
+        if cube_manifest is None:
+            raise ServerError("The specified cube doesn't exist")
+        return cube_manifest
 
     def get_cube_params(self, cube_uid: str, workspace_path: str):
-        res = requests.get(f"{self.server_url}/cubes/{cube_uid}/parameters-file")
-        if res.status_code != 200:
-            pretty_error("the specified cube doesn't exist")
+        """Retrieves the parameters file of a cube into the workspace
+
+        Args:
+            cube_uid (str): uid of the cube
+            workspace_path (str): location where the parameters file is stored
+
+        Returns:
+            str: path to the parameters file
+
+        Raises:
+            ServerError: the parameters file couldn't be retrieved
+        """
+        cached_params = self.__get_cached(
+            f"{self.server_url}/cubes/{cube_uid}/parameters-file",
+            f"{cube_uid}/parameters.yaml",
+        )
+        if cached_params is None:
+            raise ServerError("the specified cube doesn't exist")
 
         params_filepath = os.path.join(workspace_path, "parameters.yaml")
-        open(params_filepath, "wb+").write(res.content)
+        shutil.copyfile(cached_params, params_filepath)
         return params_filepath
 
-    def upload_dataset(self, dataset_reg_path):
-        parent_path = str(Path(dataset_reg_path).parent)
-        reg_sha = get_file_sha1(dataset_reg_path)
-        new_name = os.path.join(parent_path, reg_sha + ".yaml")
-        os.rename(dataset_reg_path, new_name)
-        files = {"file": open(new_name, "rb")}
-        res = requests.post(f"{self.server_url}/datasets", files=files)
+    def get_cube_files(self, metadata: dict, cube_uid: str, workspace_path: str):
+        """Downloads the cube manifest and, if included, its parameters file concurrently.
+        Both downloads finish before a failure of either is reported
+
+        Args:
+            metadata (dict): cube metadata, as returned by get_cube_metadata
+            cube_uid (str): uid of the cube
+            workspace_path (str): location where the parameters file is stored
+
+        Returns:
+            tuple: cube manifest path, parameters file path or None
+        """
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            cube_future = pool.submit(
+                self.get_cube, metadata["url"], cube_uid, metadata["sha1"]
+            )
+            params_future = None
+            if metadata["includes_parameters"]:
+                params_future = pool.submit(
+                    self.get_cube_params, cube_uid, workspace_path
+                )
+        try:
+            cube_path = cube_future.result()
+            params_path = params_future.result() if params_future else None
+        except ServerError as err:
+            pretty_error(str(err))
+        return cube_path, params_path
+
+    def upload_dataset(self, dataset_reg_path, reg_sha: str = None):
+        """Uploads a dataset registration file, streaming it from disk
+
+        Args:
+            dataset_reg_path (str): path to the registration file
+            reg_sha (str, optional): sha1 of the registration file, computed if not given
+        """
+        if reg_sha is None:
+            reg_sha = get_file_sha1(dataset_reg_path)
+        body = MultipartFileStream("file", dataset_reg_path, reg_sha + ".yaml")
+        try:
+            res = self.session.post(
+                f"{self.server_url}/datasets",
+                data=body,
+                headers={"Content-Type": body.content_type},
+                timeout=self.timeout,
+            )
+        except requests.RequestException as err:
+            pretty_error(f"Could not reach the server: {err}")
+        finally:
+            body.close()
         if res.status_code != 200:
             pretty_error("Could not registrate the dataset")
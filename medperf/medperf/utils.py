@@ -1,5 +1,8 @@
 import hashlib
+import io
 import os
+import tempfile
+import uuid
 from .config import config
 from shutil import rmtree
 import typer
@@ -35,3 +38,81 @@ def pretty_error(msg):
     typer.echo(msg)
     cleanup()
     exit()
+
+
+def stream_to_file(res, path, expected_sha1=None):
+    """Writes a streamed response to path, hashing the bytes as they arrive.
+    Data goes to a temporary file next to path that is only moved into place
+    if its sha1 matches the expected one
+
+    Args:
+        res (requests.Response): response opened with stream=True
+        path (str): destination path
+        expected_sha1 (str, optional): sha1 the content must have
+
+    Returns:
+        str: sha1 of the content, or None if it didn't match expected_sha1
+    """
+    sha1 = hashlib.sha1()
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in res.iter_content(chunk_size=config["chunk_size"]):
+                sha1.update(chunk)
+                f.write(chunk)
+        if expected_sha1 is not None and sha1.hexdigest() != expected_sha1:
+            os.remove(tmp_path)
+            return None
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return sha1.hexdigest()
+
+
+class MultipartFileStream:
+    def __init__(self, field: str, path: str, filename: str):
+        """multipart/form-data body holding a single file, read from disk in chunks
+        while it is sent instead of being loaded into memory
+
+        Args:
+            field (str): form field name
+            path (str): file to upload
+            filename (str): file name reported to the server
+        """
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        head = (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode()
+        tail = f"\r\n--{boundary}--\r\n".encode()
+        self.size = len(head) + os.path.getsize(path) + len(tail)
+        self.parts = [io.BytesIO(head), open(path, "rb"), io.BytesIO(tail)]
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(config["chunk_size"])
+            if not chunk:
+                break
+            yield chunk
+
+    def read(self, size=-1):
+        data = b""
+        while self.parts and (size < 0 or len(data) < size):
+            chunk = self.parts[0].read(size - len(data) if size >= 0 else -1)
+            if not chunk:
+                self.parts.pop(0).close()
+                continue
+            data += chunk
+        return data
+
+    def close(self):
+        for part in self.parts:
+            part.close()
+        self.parts = []
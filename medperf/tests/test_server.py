@@ -0,0 +1,171 @@
+import hashlib
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+
+from medperf.cache import Cache
+from medperf.config import config
+from medperf.server import Server
+
+MANIFEST = b"name: cube\n"
+PARAMS = b"output_statsfile: stats.yaml\n"
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        # path -> list of (status, body, delay) served in turn, the last one repeats
+        self.routes = {}
+        self.requests = []
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append(self.path)
+            responses = self.server.routes.get(self.path, [(404, b"", 0)])
+            status, body, delay = responses[0]
+            if len(responses) > 1:
+                responses.pop(0)
+        time.sleep(delay)
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stand_in():
+    server = StandInServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def storage(tmp_path, monkeypatch):
+    # pretty_error removes the temporary storage before exiting
+    tmp_storage = tmp_path / "tmp_storage"
+    tmp_storage.mkdir()
+    monkeypatch.setitem(config, "tmp_storage", str(tmp_storage))
+    monkeypatch.setitem(config, "backoff_factor", 0)
+    monkeypatch.setitem(config, "timeout", 5)
+
+
+def make_server(stand_in, tmp_path, url=None):
+    return Server(url or stand_in.url, cache=Cache(str(tmp_path / "cache")))
+
+
+def cube_metadata(stand_in, includes_parameters=True):
+    return {
+        "url": f"{stand_in.url}/cubes/1/manifest",
+        "sha1": hashlib.sha1(MANIFEST).hexdigest(),
+        "includes_parameters": includes_parameters,
+    }
+
+
+def test_requests_share_a_connection(stand_in, tmp_path):
+    stand_in.routes["/benchmarks/1"] = [(200, b'{"name": "b"}', 0)]
+    stand_in.routes["/cubes/1/metadata"] = [(200, b'{"name": "c"}', 0)]
+    server = make_server(stand_in, tmp_path)
+    assert server.get_benchmark("1") == {"name": "b"}
+    assert server.get_cube_metadata("1") == {"name": "c"}
+    assert server.get_benchmark("1") == {"name": "b"}
+    assert stand_in.connections == 1
+
+
+def test_server_errors_are_retried(stand_in, tmp_path):
+    stand_in.routes["/benchmarks/1"] = [
+        (503, b"", 0),
+        (502, b"", 0),
+        (200, b'{"name": "b"}', 0),
+    ]
+    server = make_server(stand_in, tmp_path)
+    assert server.get_benchmark("1") == {"name": "b"}
+    assert stand_in.requests == ["/benchmarks/1"] * 3
+
+
+def test_exhausted_retries_are_reported(stand_in, tmp_path, capsys):
+    stand_in.routes["/benchmarks/1"] = [(503, b"", 0)]
+    server = make_server(stand_in, tmp_path)
+    with pytest.raises(SystemExit):
+        server.get_benchmark("1")
+    assert len(stand_in.requests) == config["retries"] + 1
+    assert "doesn't exist" in capsys.readouterr().out
+
+
+def test_unreachable_server_is_reported(stand_in, tmp_path, capsys):
+    url = stand_in.url
+    stand_in.shutdown()
+    stand_in.server_close()
+    server = make_server(stand_in, tmp_path, url=url)
+    with pytest.raises(SystemExit):
+        server.get_benchmark("1")
+    assert "Could not reach the server" in capsys.readouterr().out
+
+
+def test_cube_files_download_concurrently(stand_in, tmp_path):
+    stand_in.routes["/cubes/1/manifest"] = [(200, MANIFEST, 0.5)]
+    stand_in.routes["/cubes/1/parameters-file"] = [(200, PARAMS, 0.5)]
+    workspace = tmp_path / "workspace"
+    workspace.mkdir()
+    server = make_server(stand_in, tmp_path)
+
+    start = time.perf_counter()
+    cube_path, params_path = server.get_cube_files(
+        cube_metadata(stand_in), "1", str(workspace)
+    )
+    assert time.perf_counter() - start < 0.9
+    with open(cube_path, "rb") as f:
+        assert f.read() == MANIFEST
+    with open(params_path, "rb") as f:
+        assert f.read() == PARAMS
+
+    # A cached manifest with the expected sha1 is not downloaded again
+    stand_in.requests.clear()
+    server.get_cube_files(cube_metadata(stand_in, False), "1", str(workspace))
+    assert stand_in.requests == []
+
+
+def test_cube_file_failure_waits_for_other_download(stand_in, tmp_path, capsys):
+    stand_in.routes["/cubes/1/parameters-file"] = [(200, PARAMS, 0.5)]
+    workspace = tmp_path / "workspace"
+    workspace.mkdir()
+    server = make_server(stand_in, tmp_path)
+    with pytest.raises(SystemExit):
+        server.get_cube_files(cube_metadata(stand_in), "1", str(workspace))
+    # The error is only reported once the parameters file is in place
+    assert os.path.isfile(workspace / "parameters.yaml")
+    assert "doesn't exist" in capsys.readouterr().out
+
+
+def test_hash_mismatch_is_reported(stand_in, tmp_path, capsys):
+    stand_in.routes["/cubes/1/manifest"] = [(200, b"tampered\n", 0)]
+    server = make_server(stand_in, tmp_path)
+    with pytest.raises(SystemExit):
+        server.get_cube_files(cube_metadata(stand_in, False), "1", str(tmp_path))
+    assert "hash doesn't match" in capsys.readouterr().out